@@ -12,18 +12,762 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
-__VERSION__ = (0, 1)
+__VERSION__ = (0, 2)
 
-__cache = {} # Global cache
+import os
+import sys
+import time
+import inspect
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict, namedtuple
 
-def fncache(fn):
+try:
+   import asyncio
+except ImportError:
+   asyncio = None
+
+try:
+   import queue
+except ImportError:
+   import Queue as queue
+
+try:
+   string_types = basestring
+except NameError:
+   string_types = str
+
+try:
+   getargspec = inspect.getfullargspec
+except AttributeError:
+   getargspec = inspect.getargspec
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses evictions expirations dedups refreshes refresh_failures refresh_time size bytes')
+DiskCacheInfo = namedtuple('DiskCacheInfo', 'hits misses evictions errors size bytes')
+
+_MISSING = object()
+
+class _KWD_MARK(object):
+   """
+   Separates positional from extra keyword arguments in keys. A class rather
+   than an instance so it pickles by reference for `DiskCache` keys.
+   """
+
+class _FrozenKey(tuple):
+   """
+   Cache key built from a call with unhashable arguments. Only ever equal to
+   other `_FrozenKey`s, so it can't collide with a plain argument tuple.
+   """
+   __slots__ = ()
+
+   def __eq__(self, other):
+      return(type(other) is _FrozenKey and tuple.__eq__(self, other))
+
+   def __ne__(self, other):
+      return(not self.__eq__(other))
+
+   def __hash__(self):
+      return(tuple.__hash__(self))
+
+def _freeze(obj):
+   """
+   Return a hashable representation of `obj`. Containers are tagged with
+   their type so that e.g. `[1]` and `(1,)` don't end up as the same key.
+   Other unhashable objects are pickled. Raises TypeError if that fails.
+   """
+   if isinstance(obj, (tuple, list)):
+      return((type(obj), tuple([_freeze(v) for v in obj])))
+   if isinstance(obj, dict):
+      return((type(obj), frozenset([(_freeze(k), _freeze(v)) for k, v in obj.items()])))
+   if isinstance(obj, (set, frozenset)):
+      return((type(obj), frozenset([_freeze(v) for v in obj])))
+   try:
+      hash(obj)
+      return(obj)
+   except TypeError:
+      pass
+   try:
+      return((type(obj), pickle.dumps(obj, 2)))
+   except Exception as e:
+      raise TypeError('Cannot build cache key from %r: %s' % (obj, e))
+
+def _make_key(args, kwargs):
+   """
+   Build a cache key from positional and keyword arguments. Hashable argument
+   tuples are used as-is; others are converted with `_freeze`.
+   """
+   key = args
+   if kwargs:
+      key += (_KWD_MARK,) + tuple(sorted(kwargs.items()))
+   try:
+      hash(key)
+   except TypeError:
+      key = _FrozenKey(_freeze(key))
+   return(key)
+
+def _key_maker(fn):
+   """
+   Return a function `(args, kwargs) -> key` for `fn`. Keyword arguments that
+   name positional parameters are moved into their position and omitted
+   parameters are filled in with their defaults, so that `f(1)`, `f(a=1)` and
+   `f(1, 2)` share a key if `f` is `def f(a, b=2)`.
+   """
+   try:
+      spec = getargspec(fn)
+   except TypeError:
+      return(_make_key)
+   params = spec.args
+   defaults = spec.defaults or ()
+   nr_params = len(params)
+   first_default = nr_params - len(defaults)
+
+   def make_key(args, kwargs):
+      if len(args) >= nr_params and not kwargs:
+         return(_make_key(args, kwargs))
+      bound = list(args[:nr_params])
+      kwargs = dict(kwargs)
+      for i in range(len(bound), nr_params):
+         name = params[i]
+         if name in kwargs:
+            bound.append(kwargs.pop(name))
+         elif i >= first_default:
+            bound.append(defaults[i - first_default])
+         else:
+            # Missing argument. Let the function itself raise the error.
+            return(_make_key(args, kwargs))
+      return(_make_key(tuple(bound) + args[nr_params:], kwargs))
+   return(make_key)
+
+class _Call(object):
+   """
+   A computation in progress. Other threads that need the same result wait
+   for it instead of computing it again.
+   """
+   def __init__(self):
+      self.event = threading.Event()
+      self.value = None
+      self.exc = None
+
+   def wait(self):
+      self.event.wait()
+      if self.exc is not None:
+         raise self.exc
+      return(self.value)
+
+   def done(self, value=None, exc=None):
+      self.value = value
+      self.exc = exc
+      self.event.set()
+
+class _AsyncFetch(object):
+   """
+   Coroutine returned by `Cache.fetch_async`. It calls `start` when it is
+   first run, on the event loop that awaits it, and then waits for the
+   future that `start` returns. Written as a class because this module also
+   has to load on Python 2, which has no `async def`.
+   """
+   def __init__(self, start, *args):
+      self._start = start
+      self._args = args
+      self._it = None
+
+   def __await__(self):
+      return(self)
+
+   def send(self, value):
+      if self._it is None:
+         self._it = self._start(*self._args).__await__()
+      return(self._it.send(value))
+
+   def __next__(self):
+      return(self.send(None))
+
+   def throw(self, *args):
+      if self._it is None:
+         # Cancelled before it ran: don't start anything.
+         self._it = iter(())
+         exc = args[1] if len(args) > 1 and args[1] is not None else args[0]
+         if isinstance(exc, type):
+            exc = exc()
+         raise exc
+      return(self._it.throw(*args))
+
+   def close(self):
+      self._it = iter(())
+
+if asyncio is not None:
+   from collections.abc import Coroutine
+   Coroutine.register(_AsyncFetch)
+
+class Cache(object):
+   """
+   Bounded LRU cache with an optional per-entry time-to-live. Every function
+   decorated with `fncache` gets its own instance. All methods are
+   thread-safe.
+
+   `maxsize` limits the number of entries and `maxbytes` limits the total
+   size of the cached values as reported by `sizeof` (`sys.getsizeof` by
+   default, which does not follow references). When either limit is
+   exceeded, the least recently used entries are evicted. Entries older than
+   `ttl` seconds are discarded on access. A limit of None means unbounded.
+
+   Entries older than `soft_ttl` seconds are considered stale: `fetch` still
+   returns them immediately, but queues a refresh which a background thread
+   performs by calling the function again. Until the refresh succeeds (or
+   the entry reaches `ttl`) the stale value keeps being served. The number
+   of refreshes, failed refreshes and the total time spent refreshing are
+   reported by `info`.
+
+   If a `DiskCache` is given as `disk`, `fetch` consults it on misses before
+   computing a value, and stores computed values in it. Its keys are
+   prefixed with `name`, so several caches can share one `DiskCache`.
+
+   >>> c = Cache(maxsize=2)
+   >>> c.set('a', 1); c.set('b', 2); c.get('a'); c.set('c', 3)
+   1
+   >>> c.get('b') is _MISSING
+   True
+   >>> c.fetch('d', lambda: 4)
+   4
+   >>> c.info()
+   CacheInfo(hits=1, misses=2, evictions=2, expirations=0, dedups=0, refreshes=0, refresh_failures=0, refresh_time=0.0, size=2, bytes=0)
+
+   Values larger than `maxbytes` are not cached, and replace the old value:
+
+   >>> c = Cache(maxbytes=100)
+   >>> c.set('a', 'x'); c.set('a', 'y' * 500)
+   >>> c.get('a') is _MISSING, c.info().bytes
+   (True, 0)
+   """
+   def __init__(self, maxsize=None, maxbytes=None, ttl=None, sizeof=sys.getsizeof,
+                disk=None, name=None, soft_ttl=None):
+      self.maxsize = maxsize
+      self.maxbytes = maxbytes
+      self.ttl = ttl
+      self.soft_ttl = soft_ttl
+      self.sizeof = sizeof
+      self.disk = disk
+      self.name = name
+
+      self.lock = threading.Lock()
+      self._entries = OrderedDict() # key -> (value, expires, stale, size)
+      self._inflight = {}           # key -> _Call
+      self._inflight_async = {}     # key -> asyncio.Future
+      self._refreshing = set()      # keys queued for a background refresh
+      self._refresh_queue = None
+      self.clear()
+
+   def get(self, key):
+      """
+      Return the value for `key`, or `_MISSING` if it is not cached or has
+      expired.
+      """
+      with self.lock:
+         return(self._get(key))
+
+   def set(self, key, value):
+      """
+      Store `value` under `key`, evicting least recently used entries if the
+      cache grows beyond its limits.
+      """
+      with self.lock:
+         self._set(key, value)
+
+   def fetch(self, key, fn, *args, **kwargs):
+      """
+      Return the value for `key`, calling `fn(*args, **kwargs)` and storing
+      its result on a miss (after trying `disk`, if set). If another thread
+      is already computing the value for `key`, wait for its result instead
+      (counted in `dedups`). Exceptions raised by `fn` are passed on to all
+      waiting callers and nothing is cached.
+      """
+      with self.lock:
+         entry = self._lookup(key)
+         if entry is not None:
+            if entry[2] is not None and entry[2] <= time.time():
+               self._queue_refresh(key, fn, args, kwargs)
+            return(entry[0])
+         call = self._inflight.get(key)
+         owner = call is None
+         if owner:
+            call = self._inflight[key] = _Call()
+         else:
+            self.dedups += 1
+      if not owner:
+         return(call.wait())
+
+      try:
+         value = _MISSING
+         if self.disk is not None:
+            value = self.disk.get((self.name, key))
+         if value is _MISSING:
+            value = fn(*args, **kwargs)
+            if self.disk is not None:
+               self.disk.set((self.name, key), value)
+      except BaseException as e:
+         # Also on KeyboardInterrupt and the like, or the waiters would
+         # block forever.
+         with self.lock:
+            del self._inflight[key]
+         call.done(exc=e)
+         raise
+      with self.lock:
+         self._set(key, value)
+         del self._inflight[key]
+      call.done(value)
+      return(value)
+
+   def fetch_async(self, key, fn, *args, **kwargs):
+      """
+      Like `fetch`, but for a coroutine function `fn`. Returns a coroutine
+      that resolves to the cached or computed value. Nothing happens until
+      it is awaited, so it can be created outside of a running event loop.
+      Concurrent callers for the same key share a single task running `fn`.
+      Cancelling one caller does not cancel the shared task.
+      """
+      return(_AsyncFetch(self._fetch_async, key, fn, args, kwargs))
+
+   def _fetch_async(self, key, fn, args, kwargs):
+      """
+      Start or join the lookup of `key` on the running event loop. Returns a
+      future for the value.
+      """
+      loop = asyncio.get_running_loop()
+      with self.lock:
+         entry = self._lookup(key)
+         if entry is not None:
+            if entry[2] is not None and entry[2] <= time.time() and \
+               key not in self._refreshing:
+               self._refreshing.add(key)
+               self._refresh_async(loop, key, fn, args, kwargs)
+            future = loop.create_future()
+            future.set_result(entry[0])
+            return(future)
+         task = self._inflight_async.get(key)
+         if task is not None:
+            self.dedups += 1
+            return(asyncio.shield(task))
+         task = self._inflight_async[key] = loop.create_future()
+
+      def finish(value=_MISSING, exc=None, store=False):
+         with self.lock:
+            del self._inflight_async[key]
+            if value is not _MISSING:
+               self._set(key, value)
+         if task.cancelled():
+            return
+         if isinstance(exc, asyncio.CancelledError):
+            task.cancel()
+            return
+         if exc is not None:
+            task.set_exception(exc)
+            return
+         task.set_result(value)
+         if store and self.disk is not None:
+            loop.run_in_executor(None, self.disk.set, (self.name, key), value)
+
+      def called(call):
+         if call.cancelled():
+            finish(exc=asyncio.CancelledError())
+         elif call.exception() is not None:
+            finish(exc=call.exception())
+         else:
+            finish(call.result(), store=True)
+
+      def call():
+         try:
+            asyncio.ensure_future(fn(*args, **kwargs)).add_done_callback(called)
+         except Exception as e:
+            finish(exc=e)
+
+      def looked_up(lookup):
+         # The disk tier runs SQLite in a thread so it doesn't block the
+         # event loop.
+         value = _MISSING
+         if not lookup.cancelled() and lookup.exception() is None:
+            value = lookup.result()
+         if value is _MISSING:
+            call()
+         else:
+            finish(value)
+
+      if self.disk is None:
+         call()
+      else:
+         loop.run_in_executor(None, self.disk.get, (self.name, key)).add_done_callback(looked_up)
+      return(asyncio.shield(task))
+
+   def _queue_refresh(self, key, fn, args, kwargs):
+      """
+      Queue a background refresh of `key`, unless one is already pending.
+      Starts the refresh thread on first use. Must be called with the lock
+      held.
+      """
+      if key in self._refreshing:
+         return
+      self._refreshing.add(key)
+      if self._refresh_queue is None:
+         self._refresh_queue = queue.Queue()
+         thread = threading.Thread(target=self._refresh_worker)
+         thread.daemon = True
+         thread.start()
+      self._refresh_queue.put((key, fn, args, kwargs))
+
+   def _refresh_worker(self):
+      while True:
+         key, fn, args, kwargs = self._refresh_queue.get()
+         start = time.time()
+         try:
+            value = fn(*args, **kwargs)
+         except Exception:
+            value = _MISSING
+         self._refreshed(key, value, time.time() - start)
+         if value is not _MISSING and self.disk is not None:
+            self.disk.set((self.name, key), value)
+
+   def _refresh_async(self, loop, key, fn, args, kwargs):
+      start = loop.time()
+      def done(task):
+         if task.cancelled() or task.exception() is not None:
+            self._refreshed(key, _MISSING, loop.time() - start)
+            return
+         self._refreshed(key, task.result(), loop.time() - start)
+         if self.disk is not None:
+            loop.run_in_executor(None, self.disk.set, (self.name, key), task.result())
+      asyncio.ensure_future(fn(*args, **kwargs)).add_done_callback(done)
+
+   def _refreshed(self, key, value, elapsed):
+      """
+      Record the outcome of a background refresh. `value` is `_MISSING` if it
+      failed, in which case the stale entry is kept.
+      """
+      with self.lock:
+         self._refreshing.discard(key)
+         self.refresh_time += elapsed
+         if value is _MISSING:
+            self.refresh_failures += 1
+            return
+         self.refreshes += 1
+         self._set(key, value)
+
+   def _lookup(self, key):
+      """
+      Return the `(value, expires, stale, size)` entry for `key`, or None if
+      it is not cached or has expired.
+      """
+      try:
+         entry = self._entries.pop(key)
+      except KeyError:
+         self.misses += 1
+         return(None)
+      if entry[1] is not None and entry[1] <= time.time():
+         self.bytes -= entry[3]
+         self.expirations += 1
+         self.misses += 1
+         return(None)
+      self._entries[key] = entry # Move to MRU position
+      self.hits += 1
+      return(entry)
+
+   def _get(self, key):
+      entry = self._lookup(key)
+      if entry is None:
+         return(_MISSING)
+      return(entry[0])
+
+   def _set(self, key, value):
+      # The old value is dropped even if the new one is too big to cache.
+      old = self._entries.pop(key, None)
+      if old is not None:
+         self.bytes -= old[3]
+      size = 0
+      if self.maxbytes is not None:
+         size = self.sizeof(value)
+         if size > self.maxbytes:
+            return
+      now = time.time()
+      expires = None
+      if self.ttl is not None:
+         expires = now + self.ttl
+      stale = None
+      if self.soft_ttl is not None:
+         stale = now + self.soft_ttl
+
+      self._entries[key] = (value, expires, stale, size)
+      self.bytes += size
+
+      while (self.maxsize is not None and len(self._entries) > self.maxsize) or \
+            (self.maxbytes is not None and self.bytes > self.maxbytes):
+         old_key, old = self._entries.popitem(last=False)
+         self.bytes -= old[3]
+         self.evictions += 1
+
+   def clear(self):
+      """
+      Remove all entries and reset the statistics.
+      """
+      with self.lock:
+         self._entries.clear()
+         self.bytes = 0
+         self.hits = 0
+         self.misses = 0
+         self.evictions = 0
+         self.expirations = 0
+         self.dedups = 0
+         self.refreshes = 0
+         self.refresh_failures = 0
+         self.refresh_time = 0.0
+
+   def info(self):
+      """
+      Return a `CacheInfo` tuple with the cache statistics.
+      """
+      with self.lock:
+         return(CacheInfo(self.hits, self.misses, self.evictions,
+                          self.expirations, self.dedups, self.refreshes,
+                          self.refresh_failures, self.refresh_time,
+                          len(self._entries), self.bytes))
+
+   def __len__(self):
+      return(len(self._entries))
+
+class DiskCache(object):
+   """
+   SQLite-backed cache that can be used as a second tier behind `Cache`. It
+   survives restarts and can be shared by several processes on the same host
+   (SQLite takes care of the locking). Keys and values are stored as binary
+   pickles, so both must be picklable; values that aren't are simply not
+   stored.
+
+   `maxbytes` limits the total size of the stored keys and values. When it
+   is exceeded, the least recently used entries are evicted. Entries older
+   than `ttl` seconds are discarded on access. Database errors (e.g. a lock
+   timeout) and values that can no longer be unpickled are counted in
+   `errors` and treated as misses, so a broken disk cache never breaks the
+   cached function. The database is opened on first use, and reopened in a
+   child process after a fork.
+
+   >>> import tempfile
+   >>> path = tempfile.mktemp()
+   >>> dc = DiskCache(path, maxbytes=4096)
+   >>> dc.set(('ns', 1), 'one')
+   >>> DiskCache(path).get(('ns', 1))
+   'one'
+   >>> dc.get(('ns', 2)) is _MISSING
+   True
+   >>> dc.info()
+   DiskCacheInfo(hits=0, misses=1, evictions=0, errors=0, size=1, bytes=24)
+
+   Entries that cannot be unpickled are dropped:
+
+   >>> _ = dc.conn.execute("UPDATE fncache SET value = ?", (sqlite3.Binary(b'junk'),))
+   >>> dc.get(('ns', 1)) is _MISSING
+   True
+   >>> dc.info()
+   DiskCacheInfo(hits=0, misses=2, evictions=0, errors=1, size=0, bytes=0)
+
+   A value that is too big replaces the old one with nothing:
+
+   >>> dc.set(('ns', 3), 'three'); dc.set(('ns', 3), 'x' * 8192)
+   >>> dc.get(('ns', 3)) is _MISSING
+   True
+   >>> os.unlink(path)
+   """
+   def __init__(self, path, maxbytes=None, ttl=None, timeout=10.0):
+      self.path = path
+      self.maxbytes = maxbytes
+      self.ttl = ttl
+
+      self.hits = 0
+      self.misses = 0
+      self.evictions = 0
+      self.errors = 0
+
+      self.timeout = timeout
+      self.lock = threading.Lock()
+      self._conn = None
+      self._pid = None
+
+   @property
+   def conn(self):
+      # Connect on first use, and again in a forked child: an SQLite
+      # connection must not be shared with the parent process.
+      if self._conn is None or self._pid != os.getpid():
+         self._conn = self._connect()
+         self._pid = os.getpid()
+      return(self._conn)
+
+   def _connect(self):
+      conn = sqlite3.connect(self.path, timeout=self.timeout,
+                             isolation_level=None,
+                             check_same_thread=False)
+      conn.text_factory = str
+      conn.execute("PRAGMA journal_mode=WAL")
+      conn.executescript("""
+         CREATE TABLE IF NOT EXISTS fncache (
+            key BLOB PRIMARY KEY,
+            value BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            expires REAL,
+            atime REAL NOT NULL
+         );
+         CREATE INDEX IF NOT EXISTS fncache_atime ON fncache (atime);
+         CREATE TABLE IF NOT EXISTS fncache_size (total INTEGER NOT NULL);
+         INSERT INTO fncache_size
+            SELECT 0 WHERE NOT EXISTS (SELECT * FROM fncache_size);
+         CREATE TRIGGER IF NOT EXISTS fncache_ins AFTER INSERT ON fncache
+            BEGIN UPDATE fncache_size SET total = total + NEW.size; END;
+         CREATE TRIGGER IF NOT EXISTS fncache_del AFTER DELETE ON fncache
+            BEGIN UPDATE fncache_size SET total = total - OLD.size; END;
+      """)
+      return(conn)
+
+   def get(self, key):
+      """
+      Return the value for `key`, or `_MISSING` if it is not stored or has
+      expired.
+      """
+      now = time.time()
+      try:
+         dkey = sqlite3.Binary(pickle.dumps(key, 2))
+         with self.lock:
+            row = self.conn.execute(
+               "SELECT value, expires FROM fncache WHERE key = ?", (dkey,)
+            ).fetchone()
+            if row is not None and row[1] is not None and row[1] <= now:
+               self.conn.execute("DELETE FROM fncache WHERE key = ?", (dkey,))
+               row = None
+            if row is None:
+               self.misses += 1
+               return(_MISSING)
+            self.conn.execute("UPDATE fncache SET atime = ? WHERE key = ?", (now, dkey))
+      except (sqlite3.Error, pickle.PickleError, TypeError):
+         self.errors += 1
+         return(_MISSING)
+      try:
+         value = pickle.loads(bytes(row[0]))
+      except Exception:
+         # Unpickling can fail in many ways (a class that was renamed or
+         # removed, a truncated value, ...). Drop the entry so it is
+         # recomputed.
+         self.misses += 1
+         self.errors += 1
+         try:
+            with self.lock:
+               self.conn.execute("DELETE FROM fncache WHERE key = ?", (dkey,))
+         except sqlite3.Error:
+            pass
+         return(_MISSING)
+      self.hits += 1
+      return(value)
+
+   def set(self, key, value):
+      """
+      Store `value` under `key`, evicting least recently used entries if the
+      store grows beyond `maxbytes`. If `value` can't be stored (it can't be
+      pickled or is too big), the old value under `key` is removed.
+      """
+      now = time.time()
+      try:
+         dkey = pickle.dumps(key, 2)
+      except (pickle.PickleError, TypeError):
+         return
+      try:
+         dvalue = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+      except (pickle.PickleError, TypeError):
+         dvalue = None
+      expires = None
+      if self.ttl is not None:
+         expires = now + self.ttl
+      size = len(dkey) + len(dvalue or '')
+      if self.maxbytes is not None and size > self.maxbytes:
+         dvalue = None
+
+      try:
+         with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+               # Explicit delete instead of INSERT OR REPLACE so the size
+               # triggers fire.
+               self.conn.execute("DELETE FROM fncache WHERE key = ?", (sqlite3.Binary(dkey),))
+               if dvalue is not None:
+                  self.conn.execute(
+                     "INSERT INTO fncache (key, value, size, expires, atime) VALUES (?, ?, ?, ?, ?)",
+                     (sqlite3.Binary(dkey), sqlite3.Binary(dvalue), size, expires, now)
+                  )
+               if self.maxbytes is not None:
+                  self._evict(now)
+               self.conn.execute("COMMIT")
+            except:
+               self.conn.execute("ROLLBACK")
+               raise
+      except sqlite3.Error:
+         self.errors += 1
+
+   def _evict(self, now):
+      self.conn.execute("DELETE FROM fncache WHERE expires <= ?", (now,))
+      while self.conn.execute("SELECT total FROM fncache_size").fetchone()[0] > self.maxbytes:
+         cursor = self.conn.execute(
+            "DELETE FROM fncache WHERE key IN "
+            "(SELECT key FROM fncache ORDER BY atime LIMIT 1)"
+         )
+         if cursor.rowcount <= 0:
+            break
+         self.evictions += cursor.rowcount
+
+   def clear(self):
+      """
+      Remove all entries (for all processes using the store).
+      """
+      with self.lock:
+         self.conn.execute("DELETE FROM fncache")
+
+   def info(self):
+      """
+      Return a `DiskCacheInfo` tuple with the statistics of this process and
+      the current size of the store.
+      """
+      with self.lock:
+         size = self.conn.execute("SELECT COUNT(*) FROM fncache").fetchone()[0]
+         nr_bytes = self.conn.execute("SELECT total FROM fncache_size").fetchone()[0]
+      return(DiskCacheInfo(self.hits, self.misses, self.evictions, self.errors,
+                           size, nr_bytes))
+
+def fncache(fn=None, maxsize=None, maxbytes=None, ttl=None, disk=None,
+            soft_ttl=None):
    """
    Function caching decorator. Keeps a cache of the return value of a function
    and serves from cache on consecutive calls to the function. 
    
-   Cache keys are computed from a hash of the function name and the parameters
-   (this differentiates between instances through the 'self' param). Only
-   works if parameters have a unique repr() (almost everything).
+   Cache keys are built from the parameters (this differentiates between
+   instances through the 'self' param). Keyword arguments and defaults are
+   normalized, so equivalent calls share an entry. Hashable parameters are
+   used directly; lists, dicts and sets are converted to a hashable form and
+   other unhashable parameters are pickled. If that fails, the function is
+   called without caching. Like dict keys, parameters that compare equal
+   (e.g. `1` and `1.0`) share an entry.
+
+   Each decorated function has its own `Cache`. It is unbounded by default;
+   pass `maxsize`, `maxbytes` and/or `ttl` to bound it (see `Cache`). The
+   decorated function gets `cache_info()` and `cache_clear()` methods.
+
+   The decorated function is thread-safe. When several threads miss on the
+   same key at once, only one of them calls the function; the others wait for
+   its result. `cache_info().dedups` counts these collapsed calls.
+
+   `disk` adds a persistent second tier that survives restarts and is shared
+   between processes. It can be a `DiskCache` or the path to its database.
+   Entries are namespaced by the function's module and name.
+
+   With `soft_ttl`, entries older than `soft_ttl` seconds are served stale
+   while being refreshed in the background; callers only block on entries
+   older than `ttl` (stale-while-revalidate, see `Cache`).
+
+   Coroutine functions (`async def`) are detected automatically. Their
+   decorated version returns an awaitable for the result; the awaited result
+   is cached, not the coroutine object. Concurrent awaits for the same key
+   share a single call (see `Cache.fetch_async`).
 
    Example:
 
@@ -37,8 +781,9 @@ def fncache(fn):
    I like turtles
    >>> print greenham(1)           # Cache hit
    I like turtles
-   >>> print greenham(1, 2, 3)     # Cache miss (even though default params)
-   CACHE MISS
+   >>> print greenham(1, 2, 3)     # Cache hit (same as default params)
+   I like turtles
+   >>> print greenham(1, c=3)      # Cache hit
    I like turtles
    >>> print greenham(2, 2, ['a']) # Cache miss
    CACHE MISS
@@ -48,13 +793,144 @@ def fncache(fn):
    I like turtles
    >>> print greenham(2, 2, ['a']) # Cache hit
    I like turtles
+   >>> print greenham(2, 2, ('a',)) # Cache miss
+   CACHE MISS
+   I like turtles
+   >>> greenham.cache_info()
+   CacheInfo(hits=4, misses=4, evictions=0, expirations=0, dedups=0, refreshes=0, refresh_failures=0, refresh_time=0.0, size=4, bytes=0)
+
+   Bounded cache:
+
+   >>> @fncache(maxsize=2, ttl=3600)
+   ... def square(x):
+   ...   print 'CACHE MISS'
+   ...   return(x * x)
+   ...
+   >>> square(2), square(3), square(4)
+   CACHE MISS
+   CACHE MISS
+   CACHE MISS
+   (4, 9, 16)
+   >>> square(2)                   # Cache miss (evicted)
+   CACHE MISS
+   4
+   >>> square.cache_info()
+   CacheInfo(hits=0, misses=4, evictions=2, expirations=0, dedups=0, refreshes=0, refresh_failures=0, refresh_time=0.0, size=2, bytes=0)
+   >>> square.cache_clear()
+   >>> square.cache_info()
+   CacheInfo(hits=0, misses=0, evictions=0, expirations=0, dedups=0, refreshes=0, refresh_failures=0, refresh_time=0.0, size=0, bytes=0)
    """
+   if fn is None:
+      def decorator(fn):
+         return(fncache(fn, maxsize=maxsize, maxbytes=maxbytes, ttl=ttl,
+                        disk=disk, soft_ttl=soft_ttl))
+      return(decorator)
+
+   if isinstance(disk, string_types):
+      disk = DiskCache(disk)
+   cache = Cache(maxsize=maxsize, maxbytes=maxbytes, ttl=ttl, disk=disk,
+                 name='%s.%s' % (fn.__module__, fn.__name__),
+                 soft_ttl=soft_ttl)
+   make_key = _key_maker(fn)
+   if asyncio is not None and asyncio.iscoroutinefunction(fn):
+      fetch = cache.fetch_async
+   else:
+      fetch = cache.fetch
    def new(*args, **kwargs):
-      h = hash(repr(fn) + repr(args) + repr(kwargs))
-      if not h in __cache:
-         __cache[h] = fn(*args, **kwargs)
-      return(__cache[h])
+      try:
+         key = make_key(args, kwargs)
+      except TypeError:
+         return(fn(*args, **kwargs))
+      return(fetch(key, fn, *args, **kwargs))
+   new.__doc__ = "%s %s" % (fn.__doc__, "(cached)")
+   new.cache = cache
+   new.cache_info = cache.info
+   new.cache_clear = cache.clear
+   return(new)
+
+def fncache_batch(fn=None, maxsize=None, maxbytes=None, ttl=None, disk=None):
+   """
+   Caching decorator for functions that look up many keys at once. The last
+   positional parameter of the function must be a sequence of keys, and the
+   function must return either a dict mapping keys to results or a list of
+   results in the same order as the keys.
+
+   Each key's result is cached separately (together with the other
+   parameters). On a call, only the keys that aren't cached are passed to the
+   function, in a single call, and the results are reassembled into a list
+   in the order of the requested keys. Keys for which the function returns no
+   result come back as None and aren't cached.
+
+   Cache options and methods are the same as for `fncache`.
+
+   Example:
+
+   >>> @fncache_batch
+   ... def lookup(ids):
+   ...   print 'LOOKUP', ids
+   ...   return(dict([(i, i * 10) for i in ids if i < 5]))
+   ...
+   >>> lookup([1, 2, 3])
+   LOOKUP [1, 2, 3]
+   [10, 20, 30]
+   >>> lookup([3, 4, 1, 4, 5])
+   LOOKUP [4, 5]
+   [30, 40, 10, 40, None]
+   >>> lookup.cache_info().hits
+   2
+   """
+   if fn is None:
+      def decorator(fn):
+         return(fncache_batch(fn, maxsize=maxsize, maxbytes=maxbytes, ttl=ttl,
+                              disk=disk))
+      return(decorator)
+
+   if isinstance(disk, string_types):
+      disk = DiskCache(disk)
+   cache = Cache(maxsize=maxsize, maxbytes=maxbytes, ttl=ttl, disk=disk,
+                 name='%s.%s' % (fn.__module__, fn.__name__))
+   def new(*args, **kwargs):
+      args, keys = args[:-1], list(args[-1])
+      try:
+         context = _make_key(args, kwargs)
+         cache_keys = dict([(key, _make_key((context, key), None)) for key in keys])
+      except TypeError:
+         result = fn(*(args + (keys,)), **kwargs)
+         if isinstance(result, dict):
+            return([result.get(key) for key in keys])
+         return(list(result))
+
+      values = {}
+      missing = []
+      for key in keys:
+         if key in values:
+            continue
+         value = cache.get(cache_keys[key])
+         if value is _MISSING and disk is not None:
+            value = disk.get((cache.name, cache_keys[key]))
+            if value is not _MISSING:
+               cache.set(cache_keys[key], value)
+         values[key] = value
+         if value is _MISSING:
+            missing.append(key)
+
+      if missing:
+         result = fn(*(args + (missing,)), **kwargs)
+         if not isinstance(result, dict):
+            result = dict(zip(missing, result))
+         for key in missing:
+            if key not in result:
+               values[key] = None
+               continue
+            values[key] = result[key]
+            cache.set(cache_keys[key], result[key])
+            if disk is not None:
+               disk.set((cache.name, cache_keys[key]), result[key])
+      return([values[key] for key in keys])
    new.__doc__ = "%s %s" % (fn.__doc__, "(cached)")
+   new.cache = cache
+   new.cache_info = cache.info
+   new.cache_clear = cache.clear
    return(new)
 
 if __name__ == '__main__':
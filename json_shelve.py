@@ -16,65 +16,773 @@
 
 """A JSON store to use in place of shelve. Unicode keys, FTW!
 
-This is for small stores. Everything is in memory and sync() always writes
-everything out to disk.
+This is for small stores. Everything is in memory and by default sync()
+always writes everything out to disk.
+
+For larger stores, pass journal=True. The store is then kept as a log of
+changes: a header line ("#jsonstore-log 1", the codec and a random id that
+changes whenever the log is rewritten), followed by one JSON record per
+line, either
+`[key, value]` to set a key or `[key]` to delete it. sync() appends records
+for the changed keys only, and rewrites the whole log (atomically, like a
+normal sync) once it holds more than twice as many records as there are
+keys. Either format can be opened regardless of the journal setting.
+
+Journal stores can also be opened with lazy=True, which reads values from
+the log only when they're accessed (see JSONStore).
+
+Other serializers than JSON can be used by passing the name of a codec in
+CODECS, e.g. codec="marshal+zlib". Plain files written with such a codec
+start with a header line naming it. In the log format, records are binary:
+the lengths of the encoded key and value (packed as two unsigned 32-bit
+big-endian integers, the value length being 0xffffffff for a delete),
+followed by the encoded key and value.
+
+>>> import tempfile
+>>> tmp = tempfile.mkdtemp()
+>>> path = os.path.join(tmp, "born")
+>>> store = JSONStore(path, codec="pickle+zlib")
+>>> store["tom"] = (1996, 4, 1)       # JSON would turn this into a list
+>>> store.close()
+>>> JSONStore(path)["tom"]
+(1996, 4, 1)
+>>> store = JSONStore(path, journal=True, codec="marshal")
+>>> store["dick"] = (1949, 1, 1)
+>>> del store["tom"]
+>>> store.close()
+>>> __builtin__.open(path).readline().split()[:3]
+['#jsonstore-log', '1', 'marshal']
+>>> JSONStore(path, journal=True, lazy=True, codec="marshal").items()
+[(u'dick', (1949, 1, 1))]
+>>> shutil.rmtree(tmp)
+
+For read-mostly data that is opened by many processes, a store can be
+exported to a read-only snapshot with JSONStore.export_snapshot(). A
+Snapshot is memory-mapped, so opening one takes no time and its pages are
+shared between the processes that use it.
 """
 
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
-__version__ = "2.1"
+__version__ = "2.3"
 
 import __builtin__
+import bisect
+from collections import OrderedDict
+from contextlib import contextmanager
+import marshal
+import mmap
 import os
 import shutil
+import struct
 from tempfile import NamedTemporaryFile
+import threading
+import time
 import UserDict
+import zlib
 
 try:
     import simplejson as json
 except ImportError:
     import json
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # No locking between processes
+
+LOG_HEADER = b"#jsonstore-log 1"
+CODEC_HEADER = b"#jsonstore "
+
+_FRAME = struct.Struct(b">II")
+_FRAME_DELETED = 0xffffffff
+
+# Snapshot header (magic, codec, number of keys) and the entries of its
+# table of keys (key offset, key length, value offset, value length).
+SNAPSHOT_MAGIC = b"JSSNAP01"
+_SNAPSHOT_HEADER = struct.Struct(b">8s16sQ")
+_SNAPSHOT_ENTRY = struct.Struct(b">QIQI")
+
+
+def _zlib(codec):
+    dumps, loads = codec
+    return (lambda obj: zlib.compress(dumps(obj), 1),
+            lambda data: loads(zlib.decompress(data)))
+
+# Serializers, as (dumps, loads) functions, by name. "json" is special: it
+# is written as text, using the store's json_kw.
+CODECS = {
+    "json": (json.dumps, json.loads),
+    "pickle": (lambda obj: pickle.dumps(obj, pickle.HIGHEST_PROTOCOL),
+               pickle.loads),
+    "marshal": (lambda obj: marshal.dumps(obj, 2), marshal.loads),
+}
+for _name in list(CODECS):
+    CODECS[_name + "+zlib"] = _zlib(CODECS[_name])
+
+_DELETED = object()
+
 
 class JSONStore(UserDict.DictMixin):
+    """A dict that is kept in a file. See the module documentation and
+    __init__() for the options.
+
+    >>> import tempfile
+    >>> tmp = tempfile.mkdtemp()
+    >>> path = os.path.join(tmp, "people")
+
+    Journal stores append a record for each changed key on sync():
+
+    >>> store = JSONStore(path, journal=True)
+    >>> store["tom"] = {"age": 18}
+    >>> store["dick"] = {"age": 65}
+    >>> store.sync()
+    True
+    >>> del store["dick"]
+    >>> store["harry"] = {"age": 30}
+    >>> store.sync()
+    True
+    >>> store.close()
+    >>> __builtin__.open(path).read().splitlines()[1:]
+    ['["dick", {"age": 65}]', '["tom", {"age": 18}]', '["dick"]', '["harry", {"age": 30}]']
+    >>> sorted(JSONStore(path, journal=True).items())
+    [(u'harry', {u'age': 30}), (u'tom', {u'age': 18})]
 
-    def __init__(self, path, json_kw=None, mode=0600):
+    >>> shutil.rmtree(tmp)
+    """
+
+    def __init__(self, path, json_kw=None, mode=0600, journal=False,
+                 lazy=False, max_values=None, autosync=None,
+                 autosync_changes=None, codec="json", sorted_keys=False):
         """Create a JSONStore object backed by the file at `path`.
 
         If a dict is passed in as `json_kw`, it will be used as keyword
         arguments to the json module.
+
+        If `journal` is set True, the store is written as a log of changes
+        (see the module documentation), so that sync() only has to write
+        the keys that changed.
+
+        If `lazy` is also set True, opening the store only reads the offset
+        of each key's record in the log, and values are decoded when they
+        are first accessed. The offsets are kept in an index file (`path` +
+        ".idx"), so only the part of the log written after the index needs
+        to be scanned on open. If `max_values` is given, at most that many
+        decoded values that are also on disk are kept in memory; the least
+        recently used ones are dropped and decoded again when needed.
+
+        If `autosync` (a delay in seconds) or `autosync_changes` (a number
+        of changes) is given, a background thread syncs the store that long
+        after the first unsynced change, or once that many changes were
+        made, whichever comes first. Changes made in the meantime are
+        written by the same sync. Use flush() to wait until all changes are
+        on disk, and close() to stop the thread.
+
+        Several processes can use the same store. Reading and writing the
+        file is guarded by a lock on `path` + ".lock" (where fcntl is
+        available). If another process changed the file, sync() first loads
+        its changes, so that only the keys changed by this process are
+        overwritten. Use reload() to pick up changes made by others.
+
+        `codec` names the serializer in CODECS used to write the store. A
+        file written with another codec can still be read, and is rewritten
+        with this one on the next sync.
+
+        If `sorted_keys` is set True, a sorted list of the keys is kept up to
+        date, so that prefix_keys() and range_keys() don't have to go
+        through all keys. It is saved in a file (`path` + ".keys") when the
+        store is closed or rewritten, and reused on open if the store's file
+        hasn't changed since.
+
+        A lazy store only decodes the values that are accessed, and keeps at
+        most `max_values` of them in memory, also after a sync:
+
+        >>> import tempfile
+        >>> tmp = tempfile.mkdtemp()
+        >>> path = os.path.join(tmp, "people")
+        >>> store = JSONStore(path, journal=True)
+        >>> store.update({"tom": 18, "dick": 65, "harry": 30})
+        >>> store.close()
+        >>> store = JSONStore(path, journal=True, lazy=True, max_values=1)
+        >>> store["tom"], store["harry"], len(store._data)
+        (18, 30, 1)
+        >>> store["dick"] = 66
+        >>> store.sync(force=True)      # Rewrites the log
+        True
+        >>> store["tom"], store["dick"], len(store._data)
+        (18, 66, 1)
+        >>> store.close()
+        >>> sorted(JSONStore(path, journal=True, lazy=True).items())
+        [(u'dick', 66), (u'harry', 30), (u'tom', 18)]
+        >>> shutil.rmtree(tmp)
         """
+        if lazy and not journal:
+            raise ValueError("lazy loading requires journal=True")
+        if codec not in CODECS:
+            raise ValueError("Unknown codec: %s" % codec)
+
         self.path = path
         self.json_kw = json_kw or {}
         self.mode = mode
+        self.journal = journal
+        self.lazy = lazy
+        self.max_values = max_values
+        self.codec = codec
+        self.autosync = autosync
+        self.autosync_changes = autosync_changes
+        self.stats = {"syncs": 0, "sync_time": 0.0, "bytes_written": 0,
+                      "errors": 0}
 
         self._data = {}
 
         self._synced_json_kw = None
         self._needs_sync = False
+        self._dirty = set()          # keys changed since the last sync
+        self._is_log = False         # file on disk is in the log format
+        self._file_codec = None      # codec of the file on disk
+        self._file_id = None         # id in the header of the log on disk
+        self._log_records = 0        # number of records in the log on disk
+        self._log_damaged = False    # log ends in a partially written record
 
-        if not os.path.exists(path):
-            self.sync(force=True)  # write empty dict to disk
-            return
+        # Lazy mode. Keys whose current value is on disk map to the (offset,
+        # length) of their record. Their values may also be in self._data,
+        # in which case they are in self._lru if max_values is set.
+        self._index = {}
+        self._lru = OrderedDict()
+        self._reader = None
+
+        # Multi-process access
+        self._lock_fd = None         # held lock on the lock file
+        self._file_stat = None       # file as of the last load or sync
 
+        # Autosync. All access to the store is serialized by self._lock.
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._changes = 0            # changes since the last sync
+        self._closed = False
+        self._syncer = None
+
+        self._sorted = None          # sorted keys, if sorted_keys is set
+
+        with self._file_lock(fcntl and fcntl.LOCK_EX):
+            if not os.path.exists(path):
+                self.sync(force=True)  # write empty dict to disk
+            else:
+                self._load()
+            if sorted_keys:
+                self._load_sorted_keys()
+
+        if autosync is not None or autosync_changes is not None:
+            self._syncer = threading.Thread(target=self._autosync_worker)
+            self._syncer.daemon = True
+            self._syncer.start()
+
+    def _load(self):
         # load the whole store
-        with __builtin__.open(path, 'r') as fp:
-            self.update(json.load(fp))
+        with __builtin__.open(self.path, 'rb') as fp:
+            self._file_stat = self._stat(fp)
+            header = fp.readline()
+            if header.startswith(LOG_HEADER):
+                self._is_log = True
+                fields = header.split()
+                self._file_codec = self._header_codec(b" ".join(fields[2:3]))
+                self._file_id = self._log_id(header)
+                if self.lazy:
+                    self._open_lazy(fp)
+                    # Values are read from this version of the file, even if
+                    # another process replaces it.
+                    self._reader = __builtin__.open(self.path, 'rb')
+                else:
+                    self._read_log(fp)
+            elif header.startswith(CODEC_HEADER):
+                self._file_codec = self._header_codec(header[len(CODEC_HEADER):])
+                self._data.update(CODECS[self._file_codec][1](fp.read()))
+            else:
+                self._file_codec = "json"
+                fp.seek(0)
+                self._data.update(json.load(fp))
+        self._synced_json_kw = self.json_kw
+
+    def _log_id(self, header):
+        fields = header.split()
+        if len(fields) > 3:
+            return fields[3]
+        return None
+
+    def _header_codec(self, name):
+        name = name.strip().decode("ascii") or "json"
+        if name not in CODECS:
+            raise ValueError("Unknown codec in %s: %s" % (self.path, name))
+        return name
+
+    def _stat(self, fp=None):
+        try:
+            if fp is not None:
+                st = os.fstat(fp.fileno())
+            else:
+                st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+    @contextmanager
+    def _file_lock(self, operation):
+        """Hold a lock on the lock file (shared or exclusive, as given by
+        `operation`). Does nothing if the lock is already held, or if there
+        is no fcntl."""
+        if fcntl is None or self._lock_fd is not None:
+            yield
+            return
+        self._lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT,
+                                self.mode)
+        try:
+            fcntl.flock(self._lock_fd, operation)
+            yield
+        finally:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def reload(self):
+        """Load the changes other processes made to the file since it was
+        last loaded or synced. Keys changed in this store that haven't been
+        synced yet keep their value. Returns False, without reading
+        anything, if the file hasn't changed.
+
+        Each store (or process) using the file only writes the keys it
+        changed, so stores can make changes at the same time:
+
+        >>> import tempfile
+        >>> tmp = tempfile.mkdtemp()
+        >>> path = os.path.join(tmp, "people")
+        >>> a = JSONStore(path, journal=True)
+        >>> b = JSONStore(path, journal=True)
+        >>> a["tom"] = 18
+        >>> b["dick"] = 65
+        >>> a.sync(), b.sync(), a.reload(), a.reload()
+        (True, True, True, False)
+        >>> sorted(a.items()) == sorted(b.items()) == [(u'dick', 65), (u'tom', 18)]
+        True
+        >>> a.close(); b.close()
+        >>> shutil.rmtree(tmp)
+        """
+        with self._lock:
+            with self._file_lock(fcntl and fcntl.LOCK_SH):
+                return self._refresh()
+
+    def _refresh(self):
+        st = self._stat()
+        if st is None:
+            # Removed; sync() writes it anew
+            self._is_log = False
+            return False
+        if st == self._file_stat:
+            return False
+        pending = dict([(key, self._data.get(key, _DELETED))
+                        for key in self._dirty])
+        old_st = self._file_stat
+        appended = False
+        if (self._is_log and not self._log_damaged and old_st is not None and
+                st[:2] == old_st[:2] and st[2] >= old_st[2]):
+            with __builtin__.open(self.path, 'rb') as fp:
+                # The inode may have been reused by a rewritten log
+                if self._log_id(fp.readline()) == self._file_id:
+                    # Records were appended; read just those
+                    fp.seek(old_st[2])
+                    if self.lazy:
+                        self._scan_log(fp)
+                    else:
+                        self._read_log(fp)
+                    appended = True
+        if appended:
+            self._file_stat = st
+        else:
+            self._data = {}
+            self._index = {}
+            self._lru = OrderedDict()
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+            self._is_log = False
+            self._file_id = None
+            self._log_records = 0
+            self._log_damaged = False
+            self._load()
+        for key, value in pending.iteritems():
+            if value is _DELETED:
+                self._data.pop(key, None)
+            else:
+                self._data[key] = value
+            self._index.pop(key, None)
+            self._lru.pop(key, None)
+        if self._sorted is not None:
+            self._sorted = sorted(self.keys())
+        return True
+
+    def _load_sorted_keys(self):
+        try:
+            with __builtin__.open(self.path + ".keys", 'rb') as fp:
+                saved = marshal.load(fp)
+        except (IOError, EOFError, ValueError, TypeError):
+            saved = None
+        if (isinstance(saved, dict) and saved.get("file") == self._file_stat
+                and not self._dirty):
+            self._sorted = saved["keys"]
+        else:
+            self._sorted = sorted(self.keys())
+            self._save_sorted_keys()
+
+    def _save_sorted_keys(self):
+        """Save the sorted keys in a file, along with the state of the
+        store's file they belong to."""
+        if self._dirty:
+            return  # They don't match the file
+        try:
+            data = marshal.dumps({"file": self._file_stat,
+                                  "keys": self._sorted}, 2)
+        except ValueError:
+            return
+        with self._mktemp() as fp:
+            fp.write(data)
+        shutil.move(fp.name, self.path + ".keys")
+
+    def prefix_keys(self, prefix):
+        """Return an iterator over the keys that start with `prefix`, in
+        order. Requires sorted_keys.
+
+        >>> import tempfile
+        >>> tmp = tempfile.mkdtemp()
+        >>> path = os.path.join(tmp, "people")
+        >>> store = JSONStore(path, journal=True, sorted_keys=True)
+        >>> store.update({"tom": 18, "dick": 65, "harry": 30})
+        >>> store.close()
+        >>> store = JSONStore(path, journal=True, sorted_keys=True)
+        >>> store["henry"] = 44
+        >>> del store["tom"]
+        >>> list(store.prefix_keys("h")), list(store.range_keys("e"))
+        ([u'harry', u'henry'], [u'harry', u'henry'])
+        >>> list(store.range_keys(None, "harry"))
+        [u'dick']
+        >>> store.close()
+        >>> shutil.rmtree(tmp)
+        """
+        with self._lock:
+            keys = self._sorted_keys()
+            i = bisect.bisect_left(keys, prefix)
+            end = i
+            while end < len(keys) and keys[end].startswith(prefix):
+                end += 1
+            return iter(keys[i:end])
+
+    def range_keys(self, start=None, stop=None):
+        """Return an iterator over the keys from `start` (inclusive) to
+        `stop` (exclusive), in order. Either may be None for no bound.
+        Requires sorted_keys."""
+        with self._lock:
+            keys = self._sorted_keys()
+            i = 0 if start is None else bisect.bisect_left(keys, start)
+            end = len(keys) if stop is None else bisect.bisect_left(keys, stop)
+            return iter(keys[i:end])
+
+    def _sorted_keys(self):
+        if self._sorted is None:
+            raise ValueError("Store not opened with sorted_keys=True")
+        return self._sorted
+
+    def _iter_log(self, fp, values=True):
+        """Yield (key, value, offset, length) for the records in the log from
+        the current position of `fp` on. The value is _DELETED for deletes,
+        or None if `values` is False."""
+        offset = fp.tell()
+        if self._file_codec == "json":
+            decoder = json.JSONDecoder()
+            for line in fp:
+                if not line.endswith(b"\n"):
+                    # Interrupted while appending; rewrite the log on next sync
+                    self._log_damaged = True
+                    return
+                if values:
+                    record = json.loads(line)
+                    key = record[0]
+                    value = record[1] if len(record) == 2 else _DELETED
+                else:
+                    key, end = decoder.raw_decode(line, 1)
+                    value = _DELETED if line[end:end + 1] == b"]" else None
+                yield key, value, offset, len(line)
+                offset += len(line)
+            return
+
+        loads = CODECS[self._file_codec][1]
+        while True:
+            frame = fp.read(_FRAME.size)
+            if not frame:
+                return
+            if len(frame) == _FRAME.size:
+                key_len, value_len = _FRAME.unpack(frame)
+                deleted = value_len == _FRAME_DELETED
+                size = key_len + (0 if deleted else value_len)
+                data = fp.read(size)
+            if len(frame) < _FRAME.size or len(data) < size:
+                self._log_damaged = True
+                return
+            key = loads(data[:key_len])
+            if deleted:
+                value = _DELETED
+            elif values:
+                value = loads(data[key_len:])
+            else:
+                value = None
+            yield key, value, offset, _FRAME.size + size
+            offset += _FRAME.size + size
+
+    def _read_log(self, fp):
+        for key, value, offset, length in self._iter_log(fp):
+            if value is _DELETED:
+                self._data.pop(key, None)
+            else:
+                self._data[key] = value
+            self._log_records += 1
+
+    def _decode_value(self, record):
+        """Decode the value of an encoded log record."""
+        if self._file_codec == "json":
+            return json.loads(record)[1]
+        key_len = _FRAME.unpack(record[:_FRAME.size])[0]
+        return CODECS[self._file_codec][1](record[_FRAME.size + key_len:])
+
+    def _open_lazy(self, fp):
+        offset = self._load_index(fp)
+        if offset is not None:
+            fp.seek(offset)
+        scanned = self._scan_log(fp)
+        if scanned > 1000 or offset is None:
+            self._save_index()
+
+    def _scan_log(self, fp):
+        """Index the records in the log from the current position of `fp` on,
+        decoding only the keys. Returns the number of records scanned."""
+        scanned = 0
+        for key, value, offset, length in self._iter_log(fp, values=False):
+            if value is _DELETED:
+                self._index.pop(key, None)
+            else:
+                self._index[key] = (offset, length)
+            if key in self._data:
+                # Changed by another process
+                del self._data[key]
+                self._lru.pop(key, None)
+            scanned += 1
+        self._log_records += scanned
+        return scanned
+
+    def _load_index(self, fp):
+        """Load the index file if it belongs to the log open as `fp`.
+        Returns the offset in the log up to which the index is valid, or
+        None if there's no valid index."""
+        try:
+            with __builtin__.open(self.path + ".idx", 'rb') as index_fp:
+                index = marshal.load(index_fp)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        st = os.fstat(fp.fileno())
+        if (not isinstance(index, dict) or
+                index.get("file") != (st.st_dev, st.st_ino) or
+                index.get("id") != self._file_id or
+                index["size"] > st.st_size):
+            return None
+        self._index = index["keys"]
+        self._log_records = index["records"]
+        return index["size"]
+
+    def _save_index(self):
+        """Save the index in a file. The index is a marshalled dict, which is
+        fast to load and can hold any key the codecs can."""
+        if self._log_damaged:
+            return
+        st = os.stat(self.path)
+        index = {
+            "file": (st.st_dev, st.st_ino),
+            "id": self._file_id,
+            "size": st.st_size,
+            "records": self._log_records,
+            "keys": self._index,
+        }
+        try:
+            data = marshal.dumps(index, 2)
+        except ValueError:
+            return  # Keys marshal can't handle; scan the log on open instead
+        with self._mktemp() as fp:
+            fp.write(data)
+        shutil.move(fp.name, self.path + ".idx")
+
+    def _read_record(self, key):
+        offset, length = self._index[key]
+        self._reader.seek(offset)
+        return self._reader.read(length)
+
+    def _cache(self, key):
+        """Note that the value of `key` in memory is also on disk, so it may
+        be dropped if there are more than `max_values` of those."""
+        if self.max_values is None:
+            return
+        self._lru[key] = True
+        while len(self._lru) > self.max_values:
+            self._data.pop(self._lru.popitem(last=False)[0], None)
 
     def __getitem__(self, key):
-        return self._data[key]
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                if key not in self._index:
+                    raise
+                value = self._decode_value(self._read_record(key))
+                self._data[key] = value
+                self._cache(key)
+                return value
+            if key in self._lru:
+                del self._lru[key]
+                self._lru[key] = True
+            return value
 
     def __setitem__(self, key, value):
-        self._data[key] = value
-        self._needs_sync = True
+        with self._lock:
+            if self._sorted is not None and key not in self:
+                bisect.insort(self._sorted, key)
+            self._data[key] = value
+            if self._index:
+                self._index.pop(key, None)
+                self._lru.pop(key, None)
+            self._changed_key(key)
 
     def __delitem__(self, key):
-        del self._data[key]
+        with self._lock:
+            if key not in self:
+                raise KeyError(key)
+            if self._sorted is not None:
+                del self._sorted[bisect.bisect_left(self._sorted, key)]
+            self._data.pop(key, None)
+            if self._index:
+                self._index.pop(key, None)
+                self._lru.pop(key, None)
+            self._changed_key(key)
+
+    def _changed_key(self, key):
+        self._dirty.add(key)
         self._needs_sync = True
+        self._changes += 1
+        if self._syncer is not None and (self._changes == 1 or
+                                         self._batch_full()):
+            self._changed.notify()
+
+    def _batch_full(self):
+        return (self.autosync_changes is not None and
+                self._changes >= self.autosync_changes)
+
+    def _autosync_worker(self):
+        with self._lock:
+            while not self._closed:
+                if not self._changes:
+                    self._changed.wait()
+                    continue
+                # Give other changes a chance to join this sync
+                if self.autosync is not None:
+                    deadline = time.time() + self.autosync
+                while not (self._closed or self._batch_full()):
+                    if self.autosync is None:
+                        self._changed.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._changed.wait(remaining)
+                if self._closed:
+                    break
+                try:
+                    self.sync()
+                except Exception:
+                    # Keep the changes and retry later. flush() and sync()
+                    # raise the error to the caller.
+                    self.stats["errors"] += 1
+                    self._changed.wait(self.autosync or 1)
 
     def keys(self):
-        return self._data.keys()
+        with self._lock:
+            if not self._index:
+                return self._data.keys()
+            return list(set(self._index).union(self._data))
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data or key in self._index
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        with self._lock:
+            if not self._index:
+                return len(self._data)
+            return len(self._index) + len([key for key in self._data
+                                           if key not in self._index])
+
+    def export_snapshot(self, path, codec="marshal+zlib"):
+        """Write the store to a read-only snapshot at `path`, which can be
+        opened with Snapshot. Values are encoded with `codec` (see CODECS).
+        Keys must be strings. The snapshot is written to a temporary file
+        and renamed, so processes that have the old snapshot open keep
+        seeing it.
+
+        The file starts with a header: SNAPSHOT_MAGIC, the codec name
+        (padded with NUL bytes to 16 bytes) and the number of keys, as an
+        unsigned 64-bit big-endian integer. It is followed by a table with
+        the offset and length of each key (UTF-8) and value in the file,
+        sorted by key, and then the keys and values themselves.
+        """
+        if codec not in CODECS:
+            raise ValueError("Unknown codec: %s" % codec)
+        dumps = CODECS[codec][0]
+        with self._lock:
+            keys = []
+            for key in self.keys():
+                if not isinstance(key, basestring):
+                    raise TypeError("Snapshot keys must be strings: %r" % (key, ))
+                if isinstance(key, unicode):
+                    keys.append((key.encode("utf-8"), key))
+                else:
+                    keys.append((key, key))
+            keys.sort()
+
+            table = []
+            offset = _SNAPSHOT_HEADER.size + _SNAPSHOT_ENTRY.size * len(keys)
+            prefix = os.path.basename(path) + "."
+            with NamedTemporaryFile(prefix=prefix, dir=os.path.dirname(path),
+                                    delete=False) as fp:
+                fp.seek(offset)
+                for key_data, key in keys:
+                    value_data = dumps(self[key])
+                    fp.write(key_data)
+                    fp.write(value_data)
+                    table.append(_SNAPSHOT_ENTRY.pack(
+                        offset, len(key_data),
+                        offset + len(key_data), len(value_data)))
+                    offset += len(key_data) + len(value_data)
+                fp.seek(0)
+                fp.write(_SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC,
+                                               codec.encode("ascii"),
+                                               len(keys)))
+                fp.write(b"".join(table))
+                self._fsync(fp)
+            if self.mode != 0600:  # NamedTemporaryFile uses 0600
+                os.chmod(fp.name, self.mode)
+            shutil.move(fp.name, path)
 
     def _mktemp(self):
         prefix = os.path.basename(self.path) + "."
@@ -89,23 +797,318 @@ class JSONStore(UserDict.DictMixin):
 
         If force is set True, a new file will be written even if the store
         hasn't changed since last sync.
+
+        In journal mode, only the changed keys are appended to the log,
+        unless the log has to be rewritten (see the module documentation).
+
+        The written data is fsync()ed before sync() returns.
         """
-        json_kw = json_kw or self.json_kw
-        if self._synced_json_kw != json_kw:
-            self._needs_sync = True
+        with self._lock:
+            json_kw = json_kw or self.json_kw
+            kw_changed = self._synced_json_kw != json_kw
+            if kw_changed:
+                self._needs_sync = True
 
-        if not (self._needs_sync or force):
-            return False
+            if not (self._needs_sync or force):
+                return False
+
+            start = time.time()
+            with self._file_lock(fcntl and fcntl.LOCK_EX):
+                self._refresh()
+                rewrite = (not self.journal or force or kw_changed or
+                           not self._is_log or self._log_damaged or
+                           self._file_codec != self.codec or
+                           self._log_records + len(self._dirty) > 2 * len(self))
+                if not self.journal:
+                    written = self._write_plain(json_kw)
+                elif rewrite:
+                    written = self._write_log(json_kw)
+                else:
+                    written = self._append_log(json_kw)
+                self._file_stat = self._stat()
+                self._dirty.clear()
+                if rewrite and self._sorted is not None:
+                    self._save_sorted_keys()
+
+            self._synced_json_kw = json_kw
+            self._needs_sync = False
+            self._changes = 0
+            self.stats["syncs"] += 1
+            self.stats["sync_time"] += time.time() - start
+            self.stats["bytes_written"] += written
+            return True
+
+    def flush(self):
+        """Write all changes made so far to disk and wait until they're
+        there. Returns True if anything had to be written.
+
+        >>> import tempfile
+        >>> tmp = tempfile.mkdtemp()
+        >>> path = os.path.join(tmp, "people")
+        >>> store = JSONStore(path, journal=True, autosync=60, autosync_changes=2)
+        >>> store["tom"] = 18
+        >>> store.flush(), JSONStore(path)["tom"]
+        (True, 18)
+
+        The second change below makes the autosync thread sync the store:
+
+        >>> store["dick"] = 65; store["harry"] = 30
+        >>> for i in range(100):
+        ...     if store.stats["syncs"] == 3:
+        ...         break
+        ...     time.sleep(0.05)
+        >>> store.flush(), sorted(JSONStore(path).keys())
+        (False, [u'dick', u'harry', u'tom'])
+        >>> store.close()
+        >>> shutil.rmtree(tmp)
+        """
+        return self.sync()
+
+    def close(self):
+        """Flush the store and stop the autosync thread."""
+        with self._lock:
+            self.flush()
+            if self._sorted is not None:
+                with self._file_lock(fcntl and fcntl.LOCK_SH):
+                    if self._stat() == self._file_stat:
+                        self._save_sorted_keys()
+            self._closed = True
+            self._changed.notify()
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+        if self._syncer is not None:
+            self._syncer.join()
+            self._syncer = None
+
+    def _write_plain(self, json_kw):
+        with self._mktemp() as fp:
+            if self.codec == "json":
+                # dumps() is a lot faster than dump()
+                fp.write(json.dumps(self._data, **json_kw))
+            else:
+                fp.write(CODEC_HEADER + self.codec.encode("ascii") + b"\n")
+                fp.write(CODECS[self.codec][0](self._data))
+            written = fp.tell()
+            self._fsync(fp)
+        self._replace(fp.name)
+        self._is_log = False
+        self._file_codec = self.codec
+        return written
 
+    def _write_log(self, json_kw):
+        file_id = os.urandom(8).encode("hex")
+        header = b" ".join([LOG_HEADER, self.codec.encode("ascii"), file_id]) + b"\n"
+        index = {}
+        offset = len(header)
         with self._mktemp() as fp:
-            json.dump(self._data, fp, **json_kw)
+            fp.write(header)
+            for key in self.keys():
+                if key in self._data:
+                    line = self._log_record(key, json_kw, self._data[key])
+                elif self._file_codec != self.codec:
+                    value = self._decode_value(self._read_record(key))
+                    line = self._log_record(key, json_kw, value)
+                else:
+                    line = self._read_record(key)
+                fp.write(line)
+                index[key] = (offset, len(line))
+                offset += len(line)
+            self._fsync(fp)
+        self._replace(fp.name)
+        self._is_log = True
+        self._file_codec = self.codec
+        self._file_id = file_id
+        self._log_records = len(index)
+        self._log_damaged = False
+        if self.lazy:
+            self._index = index
+            self._lru = OrderedDict()
+            for key in list(self._data):
+                if key in self._data:  # not dropped by _cache() yet
+                    self._cache(key)
+            self._save_index()
+        return offset
+
+    def _append_log(self, json_kw):
+        with __builtin__.open(self.path, 'ab') as fp:
+            fp.seek(0, os.SEEK_END)
+            offset = fp.tell()
+            keys = list(self._dirty)
+            lines = [self._log_record(key, json_kw,
+                                      self._data.get(key, _DELETED))
+                     for key in keys]
+            try:
+                fp.write(b"".join(lines))
+                self._fsync(fp)
+            except:
+                # Part of the records may have been written. Rewrite the log
+                # on the next sync instead of appending after them.
+                self._log_damaged = True
+                raise
+        # Only now that the records are on disk may the values be dropped
+        # from memory.
+        if self.lazy:
+            for key, line in zip(keys, lines):
+                if key in self._data:
+                    self._index[key] = (offset, len(line))
+                    self._cache(key)
+                offset += len(line)
+        self._log_records += len(keys)
+        return sum([len(line) for line in lines])
+
+    def _fsync(self, fp):
+        fp.flush()
+        os.fsync(fp.fileno())
+
+    def _log_record(self, key, json_kw, value):
+        """Encode a log record setting `key` to `value`, or deleting it if
+        `value` is _DELETED."""
+        if self.codec != "json":
+            dumps = CODECS[self.codec][0]
+            key_data = dumps(key)
+            if value is _DELETED:
+                return _FRAME.pack(len(key_data), _FRAME_DELETED) + key_data
+            value_data = dumps(value)
+            return _FRAME.pack(len(key_data), len(value_data)) + key_data + value_data
+
+        if value is _DELETED:
+            record = [key]
+        else:
+            record = [key, value]
+        # Records must fit on a single line
+        json_kw = dict(json_kw, indent=None)
+        line = json.dumps(record, **json_kw)
+        if isinstance(line, unicode):
+            line = line.encode("utf-8")
+        return line + b"\n"
+
+    def _replace(self, tmp_path):
         if self.mode != 0600:  # _mktemp uses 0600 by default
-            os.chmod(fp.name, self.mode)
-        shutil.move(fp.name, self.path)
+            os.chmod(tmp_path, self.mode)
+        shutil.move(tmp_path, self.path)
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        if self.lazy:
+            self._reader = __builtin__.open(self.path, 'rb')
 
-        self._synced_json_kw = json_kw
-        self._needs_sync = False
-        return True
+
+class Snapshot(UserDict.DictMixin):
+    """A read-only store, memory-mapped from a file written by
+    JSONStore.export_snapshot(). Keys are looked up with a binary search on
+    the file's table of keys, and values are decoded on every access.
+    Iteration is in key order.
+
+    >>> import tempfile
+    >>> tmp = tempfile.mkdtemp()
+    >>> store = JSONStore(os.path.join(tmp, "people"))
+    >>> store.update({"tom": {"age": 18}, "dick": {"age": 65}, "harry": {"age": 30}})
+    >>> store.export_snapshot(os.path.join(tmp, "people.snap"))
+    >>> snap = Snapshot(os.path.join(tmp, "people.snap"))
+    >>> snap["tom"], "nobody" in snap, len(snap), list(snap)
+    ({u'age': 18}, False, 3, [u'dick', u'harry', u'tom'])
+    >>> list(snap.prefix_keys("h")), list(snap.range_keys("e"))
+    ([u'harry'], [u'harry', u'tom'])
+    >>> snap.close()
+    >>> shutil.rmtree(tmp)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with __builtin__.open(path, 'rb') as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, codec, self._count = _SNAPSHOT_HEADER.unpack_from(self._mmap)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("Not a snapshot: %s" % path)
+        self.codec = codec.rstrip(b"\0").decode("ascii")
+        if self.codec not in CODECS:
+            raise ValueError("Unknown codec in %s: %s" % (path, self.codec))
+        self._loads = CODECS[self.codec][1]
+
+    def _entry(self, i):
+        return _SNAPSHOT_ENTRY.unpack_from(
+            self._mmap, _SNAPSHOT_HEADER.size + i * _SNAPSHOT_ENTRY.size)
+
+    def _key(self, i):
+        key_offset, key_length, value_offset, value_length = self._entry(i)
+        return self._mmap[key_offset:key_offset + key_length]
+
+    def _bisect(self, key):
+        """Return the position of the first key in the table that isn't less
+        than `key` (UTF-8)."""
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _find(self, key):
+        """Return the entry for `key`, or None."""
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        elif not isinstance(key, bytes):
+            return None
+        i = self._bisect(key)
+        if i < self._count and self._key(i) == key:
+            return self._entry(i)
+        return None
+
+    def prefix_keys(self, prefix):
+        """Yield the keys that start with `prefix`, in order."""
+        prefix = prefix.encode("utf-8")
+        for i in xrange(self._bisect(prefix), self._count):
+            key = self._key(i)
+            if not key.startswith(prefix):
+                break
+            yield key.decode("utf-8")
+
+    def range_keys(self, start=None, stop=None):
+        """Yield the keys from `start` (inclusive) to `stop` (exclusive), in
+        order. Either may be None for no bound."""
+        i = 0 if start is None else self._bisect(start.encode("utf-8"))
+        end = self._count if stop is None else self._bisect(stop.encode("utf-8"))
+        for i in xrange(i, end):
+            yield self._key(i).decode("utf-8")
+
+    def __getitem__(self, key):
+        entry = self._find(key)
+        if entry is None:
+            raise KeyError(key)
+        key_offset, key_length, value_offset, value_length = entry
+        return self._loads(self._mmap[value_offset:value_offset + value_length])
+
+    def __setitem__(self, key, value):
+        raise TypeError("Snapshots are read-only")
+
+    def __delitem__(self, key):
+        raise TypeError("Snapshots are read-only")
+
+    def keys(self):
+        return list(self)
+
+    def __iter__(self):
+        for i in xrange(self._count):
+            yield self._key(i).decode("utf-8")
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    has_key = __contains__
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._mmap.close()
 
 
 open = JSONStore
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
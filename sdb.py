@@ -12,7 +12,570 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
-__VERSION__ = (0, 1)
+__VERSION__ = (0, 2)
+
+import array
+import bisect
+import csv
+import hashlib
+import heapq
+import multiprocessing
+import operator
+import os
+import threading
+import time
+import warnings
+from itertools import count, islice, izip
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+class SDBError(Exception):
+	pass
+
+# Operators for declarative predicates. See `SDB.select()`.
+OPS = {
+	'==': operator.eq,
+	'!=': operator.ne,
+	'<': operator.lt,
+	'<=': operator.le,
+	'>': operator.gt,
+	'>=': operator.ge,
+	'in': lambda value, arg: value in arg,
+	'prefix': lambda value, arg: value.startswith(arg),
+	'between': lambda value, arg: arg[0] <= value <= arg[1],
+}
+
+def _min(a, b):
+	if a is None or (b is not None and b < a):
+		return(b)
+	return(a)
+
+def _max(a, b):
+	if a is None or (b is not None and b > a):
+		return(b)
+	return(a)
+
+# Aggregate functions for `SDB.aggregate()`: (initial state, update state
+# with a value, final result from state, merge two states)
+AGGREGATES = {
+	'count': (lambda: 0, lambda acc, value: acc + 1, lambda acc: acc, operator.add),
+	'sum': (lambda: 0, operator.add, lambda acc: acc, operator.add),
+	'min': (lambda: None, _min, lambda acc: acc, _min),
+	'max': (lambda: None, _max, lambda acc: acc, _max),
+	'avg': (lambda: (0, 0), lambda acc, value: (acc[0] + value, acc[1] + 1), lambda acc: acc[0] / float(acc[1]) if acc[1] else None, lambda a, b: (a[0] + b[0], a[1] + b[1])),
+}
+
+# Parallel queries fork worker processes, which inherit the job from this
+# global, so that neither the data nor the predicate has to be pickled.
+_parallel_job = None
+_parallel_lock = threading.Lock()
+
+def _parallel_map(job, chunks, workers):
+	"""
+	Run `job(chunk)` for each chunk in a pool of `workers` processes and
+	return the results in order. `job` is inherited by the forked workers, so
+	it needn't be picklable, but its results must be.
+	"""
+	global _parallel_job
+	with _parallel_lock:
+		_parallel_job = job
+		try:
+			pool = multiprocessing.Pool(workers)
+			try:
+				return(pool.map(_parallel_worker, chunks, 1))
+			finally:
+				pool.close()
+				pool.join()
+		finally:
+			_parallel_job = None
+
+def _parallel_worker(chunk):
+	return(_parallel_job(chunk))
+
+def _leaf_test(col_index, op_fn, arg):
+	return(lambda row: op_fn(row[col_index], arg))
+
+def _and_test(test_a, test_b):
+	return(lambda row: test_a(row) and test_b(row))
+
+def _or_test(test_a, test_b):
+	return(lambda row: test_a(row) or test_b(row))
+
+def _not_test(test):
+	return(lambda row: not test(row))
+
+def _file_id(path):
+	"""
+	Return a string that identifies the current version of the file at
+	`path`, as long as it isn't copied or moved. Journals written by older
+	versions use this to identify their base file.
+	"""
+	st = os.stat(path)
+	return('%d %d %r' % (st.st_ino, st.st_size, st.st_mtime))
+
+def _file_digest(path):
+	"""
+	Return a string that identifies the contents of the file at `path`: its
+	size and MD5 checksum. Used to tie a journal to the base file it applies
+	to, also after both are copied or restored from a backup.
+	"""
+	digest = hashlib.md5()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(1048576), ''):
+			digest.update(block)
+		return('%d %s' % (f.tell(), digest.hexdigest()))
+
+def _move_aside(path):
+	"""
+	Rename the file at `path` to the first free name of the form `path.N`,
+	and return that name.
+	"""
+	for i in count(1):
+		new_path = '%s.%d' % (path, i)
+		if not os.path.exists(new_path):
+			os.rename(path, new_path)
+			return(new_path)
+
+def _in_quotes(line, sep, in_quotes=False):
+	"""
+	Return True if `line` ends inside a quoted field, following the rules of
+	the `csv` module: a quote only starts a quoted field at the start of a
+	field, and a doubled quote inside it stands for a quote. `in_quotes`
+	tells whether the line starts inside a quoted field.
+	"""
+	pos = 0
+	while True:
+		if in_quotes:
+			pos = line.find('"', pos)
+			if pos == -1:
+				return(True)
+			if line[pos + 1:pos + 2] == '"':
+				pos += 2
+				continue
+			in_quotes = False
+		elif line[pos:pos + 1] == '"':
+			in_quotes = True
+			pos += 1
+			continue
+		pos = line.find(sep, pos)
+		if pos == -1:
+			return(False)
+		pos += 1
+
+def _records(lines, sep):
+	"""
+	Join `lines` into records of fields separated by `sep` (a single
+	character). A quoted field may contain newlines, in which case the record
+	continues on the next line. The last record is incomplete (ends inside
+	quotes) if the lines run out before its closing quote.
+	"""
+	lines = iter(lines)
+	for line in lines:
+		if '"' in line and _in_quotes(line, sep):
+			record = [line]
+			in_quotes = True
+			while in_quotes:
+				try:
+					line = next(lines)
+				except StopIteration:
+					break
+				record.append(line)
+				in_quotes = _in_quotes(line, sep, True)
+			line = ''.join(record)
+		yield line
+
+class Index(object):
+	"""
+	Hash index on a single column. Maps each value in column `col` (a
+	position in the row) to the ascending list of positions of the rows in
+	`SDB.data` that have that value.
+	"""
+	def __init__(self, col):
+		self.col = col
+		self.map = {}
+
+	def build(self, data):
+		"""
+		(Re)build the index from the rows in `data`.
+		"""
+		self.map = {}
+		col = self.col
+		for pos, row in enumerate(data):
+			self.map.setdefault(row[col], []).append(pos)
+
+	def add(self, value, pos):
+		bucket = self.map.setdefault(value, [])
+		if not bucket or bucket[-1] < pos:
+			bucket.append(pos)
+		else:
+			bisect.insort(bucket, pos)
+
+	def extend(self, values, start):
+		"""
+		Add `values` for consecutive positions from `start` on, which must be
+		past all positions already in the index.
+		"""
+		setdefault = self.map.setdefault
+		for pos, value in enumerate(values, start):
+			setdefault(value, []).append(pos)
+
+	def remove(self, value, pos):
+		bucket = self.map[value]
+		bucket.remove(pos)
+		if not bucket:
+			del self.map[value]
+
+	def lookup(self, value):
+		"""
+		Return the positions of the rows where the column equals `value`.
+		"""
+		return(self.map.get(value, []))
+
+class ColumnStore(object):
+	"""
+	Column-oriented storage for SDB rows. Columns of type int or float (as
+	declared in `col_types`) are kept in compact `array.array`s; other columns
+	are kept in lists, with strings interned so that repeated values are
+	stored only once. Behaves like a list of rows, but reading a row builds a
+	new list, so changes to it must be written back with `store[pos] = row`.
+
+	Int columns hold machine-sized (64-bit) integers; storing larger values
+	raises OverflowError.
+	"""
+	TYPECODES = {int: 'l', float: 'd'}
+
+	def __init__(self, col_types, rows=None):
+		self.columns = []
+		for col_type in col_types:
+			typecode = self.TYPECODES.get(col_type)
+			if typecode:
+				self.columns.append(array.array(typecode))
+			else:
+				self.columns.append([])
+		if rows:
+			self.extend(rows)
+
+	def append(self, row):
+		for column, value in izip(self.columns, row):
+			if type(value) is str:
+				value = intern(value)
+			column.append(value)
+
+	def extend(self, rows):
+		rows = list(rows)
+		if rows:
+			self.extend_columns(zip(*rows))
+
+	def extend_columns(self, columns):
+		"""
+		Append rows given as a list of columns (each a sequence of values).
+		"""
+		for column, values in izip(self.columns, columns):
+			if not isinstance(column, array.array):
+				values = [intern(value) if type(value) is str else value for value in values]
+			column.extend(values)
+
+	def pop(self, pos):
+		return([column.pop(pos) for column in self.columns])
+
+	def set_values(self, col_index, positions, value):
+		"""
+		Set column `col_index` to `value` in the rows at `positions`.
+		"""
+		column = self.columns[col_index]
+		if type(value) is str:
+			value = intern(value)
+		for pos in positions:
+			column[pos] = value
+
+	def keep(self, positions):
+		"""
+		Drop all rows except the ones at (sorted) `positions`, rebuilding each
+		column in a single pass.
+		"""
+		for i, column in enumerate(self.columns):
+			kept = [column[pos] for pos in positions]
+			if isinstance(column, array.array):
+				kept = array.array(column.typecode, kept)
+			self.columns[i] = kept
+
+	def scan(self, col_index, op_fn, arg):
+		"""
+		Return the positions of the rows for which `op_fn(value, arg)` is true
+		for the value in column `col_index`. Uses NumPy to do this in a single
+		vectorized operation for numeric columns if it is available.
+		"""
+		column = self.columns[col_index]
+		if numpy is not None and isinstance(column, array.array) and len(column):
+			values = numpy.frombuffer(column, dtype=column.typecode)
+			return(numpy.flatnonzero(op_fn(values, arg)).tolist())
+		return([pos for pos, value in enumerate(column) if op_fn(value, arg)])
+
+	def __getitem__(self, pos):
+		return([column[pos] for column in self.columns])
+
+	def __setitem__(self, pos, row):
+		for column, value in izip(self.columns, row):
+			if type(value) is str:
+				value = intern(value)
+			column[pos] = value
+
+	def __len__(self):
+		if not self.columns:
+			return(0)
+		return(len(self.columns[0]))
+
+	def __iter__(self):
+		for row in izip(*self.columns):
+			yield list(row)
+
+class FileRows(object):
+	"""
+	Rows of an SDB file, read lazily. Every iteration reads the file from the
+	start, one line at a time, so memory use doesn't depend on the file size.
+	`parse` turns a line into a row. If `sep` is given, fields are separated
+	by it and may be quoted, and a row continues on the next line while it is
+	inside a quoted field.
+	"""
+	def __init__(self, path, parse, sep=None):
+		self.path = path
+		self.parse = parse
+		if sep is None:
+			self.records = iter
+		else:
+			self.records = lambda lines: _records(lines, sep)
+		self._aligned = {}
+
+	def __iter__(self):
+		with open(self.path, 'rb') as f:
+			for record in self.records(f):
+				yield self.parse(record)
+
+	def offsets(self):
+		"""
+		Yield `(offset, row)` for each row, where `offset` is the byte offset
+		of the row in the file.
+		"""
+		offset = 0
+		with open(self.path, 'rb') as f:
+			for record in self.records(f):
+				yield offset, self.parse(record)
+				offset += len(record)
+
+	def align(self, offsets):
+		"""
+		Move each of the ascending byte `offsets` forward to the start of a
+		row (or the end of the file). This reads the file up to the last
+		offset, so the result is remembered until the file changes.
+		"""
+		offsets = list(offsets)
+		key = (_file_id(self.path), tuple(offsets))
+		if key in self._aligned:
+			return(self._aligned[key])
+		aligned = []
+		offset = 0
+		with open(self.path, 'rb') as f:
+			for record in self.records(f):
+				while len(aligned) < len(offsets) and offsets[len(aligned)] <= offset:
+					aligned.append(offset)
+				if len(aligned) == len(offsets):
+					break
+				offset += len(record)
+		aligned += [offset] * (len(offsets) - len(aligned))
+		self._aligned = {key: aligned}
+		return(aligned)
+
+	def rows_between(self, start, end):
+		"""
+		Yield the rows whose lines start at a byte offset in [start, end).
+		With quoted rows, `start` must be the start of a row (see `align()`).
+		"""
+		with open(self.path, 'rb') as f:
+			if start > 0:
+				# Skip the rest of the line that started before `start`
+				f.seek(start - 1)
+				f.readline()
+			offset = f.tell()
+			for record in self.records(iter(f.readline, '')):
+				if offset >= end:
+					break
+				yield self.parse(record)
+				offset += len(record)
+
+	def read_at(self, offset):
+		"""
+		Read the row at byte offset `offset`.
+		"""
+		with open(self.path, 'rb') as f:
+			f.seek(offset)
+			return(self.parse(next(self.records(iter(f.readline, '')), '')))
+
+_INF = float('inf') # Greater than any row position
+
+class SortedIndex(object):
+	"""
+	Sorted index on a single column. Keeps `(value, position)` pairs for
+	column `col` in sorted order, so that besides equality lookups it can
+	answer range conditions and produce rows in column order.
+	"""
+	RANGE_OPS = ('==', '<', '<=', '>', '>=', 'between', 'prefix')
+
+	def __init__(self, col):
+		self.col = col
+		self.entries = []
+
+	def build(self, data):
+		col = self.col
+		self.entries = sorted([(row[col], pos) for pos, row in enumerate(data)])
+
+	def add(self, value, pos):
+		bisect.insort(self.entries, (value, pos))
+
+	def remove(self, value, pos):
+		del self.entries[bisect.bisect_left(self.entries, (value, pos))]
+
+	def lookup(self, value):
+		return(self.range('==', value))
+
+	def range(self, op, arg):
+		"""
+		Return the ascending positions of the rows where the column value
+		satisfies condition `(op, arg)`. `op` must be one of `RANGE_OPS`.
+		"""
+		entries = self.entries
+		lo, hi = 0, len(entries)
+		if op in ('>', '>=', '==', 'between', 'prefix'):
+			low = arg[0] if op == 'between' else arg
+			if op == '>':
+				lo = bisect.bisect_right(entries, (low, _INF))
+			else:
+				lo = bisect.bisect_left(entries, (low, ))
+		if op in ('<', '<=', '==', 'between'):
+			high = arg[1] if op == 'between' else arg
+			if op == '<':
+				hi = bisect.bisect_left(entries, (high, ))
+			else:
+				hi = bisect.bisect_right(entries, (high, _INF))
+		if op == 'prefix':
+			hi = lo
+			while hi < len(entries) and entries[hi][0].startswith(arg):
+				hi += 1
+		return(sorted([pos for value, pos in entries[lo:hi]]))
+
+	def ordered(self, reverse=False):
+		"""
+		Yield row positions in the order of the column values (descending if
+		`reverse`). Rows with equal values are yielded in position order, as
+		a stable sort would.
+		"""
+		entries = self.entries
+		if not reverse:
+			for value, pos in entries:
+				yield pos
+			return
+		end = len(entries)
+		while end > 0:
+			start = bisect.bisect_left(entries, (entries[end - 1][0], ), 0, end)
+			for i in xrange(start, end):
+				yield entries[i][1]
+			end = start
+
+class _Desc(object):
+	"""
+	Sort key wrapper that reverses the ordering of `value`.
+	"""
+	__slots__ = ('value', )
+
+	def __init__(self, value):
+		self.value = value
+
+	def __lt__(self, other):
+		return(other.value < self.value)
+
+	def __eq__(self, other):
+		return(self.value == other.value)
+
+class RowView(object):
+	"""
+	Read-only view on a raw row that gives access to its columns by name (or
+	by position), like the dicts SDB returns, without copying the row.
+	`col_map` maps column names to positions and is shared by all views of
+	an SDB. Use `dict(view)` to get a real dict.
+
+	Views on rows in list storage see later changes to the row.
+	"""
+	__slots__ = ('_col_map', '_row')
+
+	def __init__(self, col_map, row):
+		self._col_map = col_map
+		self._row = row
+
+	def __getitem__(self, key):
+		try:
+			return(self._row[self._col_map[key]])
+		except KeyError:
+			if type(key) is not int:
+				raise
+			return(self._row[key])
+
+	def get(self, key, default=None):
+		try:
+			return(self[key])
+		except (KeyError, IndexError):
+			return(default)
+
+	def keys(self):
+		return(list(self._col_map))
+
+	def values(self):
+		return([self._row[col_index] for col_index in self._col_map.itervalues()])
+
+	def items(self):
+		row = self._row
+		return([(col, row[col_index]) for col, col_index in self._col_map.iteritems()])
+
+	def iterkeys(self):
+		return(iter(self._col_map))
+
+	def itervalues(self):
+		row = self._row
+		return(row[col_index] for col_index in self._col_map.itervalues())
+
+	def iteritems(self):
+		row = self._row
+		return((col, row[col_index]) for col, col_index in self._col_map.iteritems())
+
+	def copy(self):
+		"""
+		Return the row as a real dict.
+		"""
+		return(dict(self.iteritems()))
+
+	__iter__ = iterkeys
+
+	def __contains__(self, key):
+		return(key in self._col_map)
+
+	has_key = __contains__
+
+	def __len__(self):
+		return(len(self._col_map))
+
+	def __eq__(self, other):
+		if isinstance(other, RowView):
+			other = dict(other.items())
+		return(dict(self.items()) == other)
+
+	def __ne__(self, other):
+		return(not self == other)
+
+	__hash__ = None
+
+	def __repr__(self):
+		return(repr(dict(self.items())))
 
 class SDB(object):
 	"""
@@ -39,6 +602,25 @@ class SDB(object):
 	>>> sdb.select(lambda row: row['age'] < 65, lambda a, b: cmp(a['age'], b['age']))
 	[{'age': 18, 'name': 'tom', 'occupation': 'Student'}, {'age': 20, 'name': 'seymore', 'occupation': 'Student'}, {'age': 30, 'name': 'harry', 'occupation': 'Unemployed'}]
 
+	# Sort by one or more columns ('-' for descending) and limit the results
+	>>> sdb.select({'occupation': ('!=', 'Retired')}, order_by=['occupation', '-age'], limit=2)
+	[{'age': 20, 'name': 'seymore', 'occupation': 'Student'}, {'age': 18, 'name': 'tom', 'occupation': 'Student'}]
+
+	# A sorted index serves ordered results and ranges without sorting
+	>>> sdb.add_index('age', sorted=True)
+	>>> sdb.select({'age': ('>', 18)}, order_by='-age', limit=1, offset=1)
+	[{'age': 30, 'name': 'harry', 'occupation': 'Unemployed'}]
+
+	# Select using a declarative predicate (all conditions must match)
+	>>> sdb.select({'occupation': 'Student', 'age': ('>', 18)})
+	[{'age': 20, 'name': 'seymore', 'occupation': 'Student'}]
+
+	# Declarative predicates can be combined with 'and', 'or' and 'not'
+	>>> sdb.select(('or', {'age': ('>=', 60)}, {'name': ('prefix', 'h')}))
+	[{'age': 65, 'name': 'dick', 'occupation': 'Retired'}, {'age': 30, 'name': 'harry', 'occupation': 'Unemployed'}]
+	>>> sdb.select({'name': ('in', ['tom', 'dick', 'jane'])})
+	[{'age': 18, 'name': 'tom', 'occupation': 'Student'}, {'age': 65, 'name': 'dick', 'occupation': 'Retired'}]
+
 	# Save
 	>>> sdb.save('occup.dat')
 
@@ -69,35 +651,143 @@ class SDB(object):
 	>>> sdb.getx(name='seymore', occupation='Student')
 	{'age': 20, 'name': 'seymore', 'occupation': 'Student'}
 
+	# Add an index to speed up getx() on a column
+	>>> sdb.add_index('occupation')
+	>>> sdb.getx(occupation='Jolly man')
+	{'age': 350, 'name': 'claus', 'occupation': 'Jolly man'}
+
 	# Delete all rows where age < 30
 	>>> sdb.delete(lambda row: row['age'] < 30)
 
+	# Update and delete need a predicate, so they don't change all rows by accident
+	>>> sdb.delete({})
+	Traceback (most recent call last):
+	SDBError: A predicate is required, got {}
+
 	# Select all rows
 	>>> sdb.select()
 	[{'age': 65, 'name': 'dick', 'occupation': 'Retired'}, {'age': 30, 'name': 'harry', 'occupation': 'Unemployed'}, {'age': 350, 'name': 'claus', 'occupation': 'Jolly man'}]
 
+	# Aggregate, optionally grouped by one or more columns
+	>>> sdb.aggregate({'n': ('count', None), 'oldest': ('max', 'age')})
+	{'oldest': 350, 'n': 3}
+	>>> sorted(sdb.aggregate({'avg_age': ('avg', 'age')}, group_by='occupation').items())
+	[('Jolly man', {'avg_age': 350.0}), ('Retired', {'avg_age': 65.0}), ('Unemployed', {'avg_age': 30.0})]
+
+	# Spread a scan over 2 worker processes
+	>>> sdb.select(lambda row: row['age'] > 60, workers=2)
+	[{'age': 65, 'name': 'dick', 'occupation': 'Retired'}, {'age': 350, 'name': 'claus', 'occupation': 'Jolly man'}]
+
+	# Columnar storage
+	>>> sdb = SDB(path='occup.dat', cols=['name', 'age', 'occupation'], id='name', col_types=[str, int, str], columnar=True)
+	>>> sdb.column('age')
+	array('l', [18, 65, 30, 20])
+	>>> sdb.select({'age': ('<', 30)})
+	[{'age': 18, 'name': 'tom', 'occupation': 'Student'}, {'age': 20, 'name': 'seymore', 'occupation': 'Student'}]
+
+	# Streaming: rows are read from the file as needed
+	>>> sdb = SDB(path='occup.dat', cols=['name', 'age', 'occupation'], id='name', col_types=[str, int, str], stream=True)
+	>>> [row['name'] for row in sdb.iselect({'occupation': 'Student'})]
+	['tom', 'seymore']
+	>>> sdb.build_offset_index()
+	>>> sdb.get('harry')
+	{'age': 30, 'name': 'harry', 'occupation': 'Unemployed'}
+
+	# Journal mode: changes are appended to a journal on save()
+	>>> sdb = SDB(path='occup.dat', cols=['name', 'age', 'occupation'], id='name', col_types=[str, int, str], journal=True)
+	>>> sdb.insert(['claus', 350, 'Jolly man'])
+	>>> sdb.delete({'name': 'dick'})
+	>>> sdb.save()
+	>>> open('occup.dat.journal').readlines()[1:]
+	['I,claus,350,Jolly man\\n', 'D,1\\n']
+	>>> sdb = SDB(path='occup.dat', cols=['name', 'age', 'occupation'], id='name', col_types=[str, int, str], journal=True)
+	>>> [row['name'] for row in sdb]
+	['tom', 'harry', 'seymore', 'claus']
+	>>> import shutil
+	>>> shutil.copy('occup.dat', 'occup2.dat'); shutil.copy('occup.dat.journal', 'occup2.dat.journal')
+	>>> [row['name'] for row in SDB(path='occup2.dat', cols=['name', 'age', 'occupation'], id='name', col_types=[str, int, str], journal=True)]
+	['tom', 'harry', 'seymore', 'claus']
+	>>> os.unlink('occup2.dat'); os.unlink('occup2.dat.journal')
+	>>> sdb.compact()
+	>>> len(open('occup.dat.journal').readlines())
+	1
+	>>> sdb.journal_max = 0
+	>>> sdb.insert(['dick', 65, 'Retired'])
+	>>> sdb.save()          # Starts a compaction in the background
+	>>> sdb.compact()
+	>>> len(open('occup.dat.journal').readlines()), len(open('occup.dat').readlines())
+	(1, 5)
+
+	# Insert, update and delete many rows at once
+	>>> sdb = SDB(cols=['name', 'age'], id='name', indexes=['age'])
+	>>> sdb.insert_many([['anne', 31], ['bob', 42], ['carol', 31], ['dave', 57]])
+	>>> sdb.update({'age': 32}, {'age': 31})
+	>>> sdb.delete({'age': ('>', 40)})
+	>>> sdb.select(), sdb.getx(age=32)
+	([{'age': 32, 'name': 'anne'}, {'age': 32, 'name': 'carol'}], {'age': 32, 'name': 'anne'})
+
+	# Return lightweight views on the rows instead of dicts
+	>>> sdb = SDB(data=[['tom', 18], ['dick', 65]], cols=['name', 'age'], id='name', views=True)
+	>>> row = sdb.get('dick')
+	>>> row, row['age'], row[0], type(row).__name__
+	({'age': 65, 'name': 'dick'}, 65, 'dick', 'RowView')
+	>>> row.has_key('age'), sorted(row.iteritems()), row.copy()
+	(True, [('age', 65), ('name', 'dick')], {'age': 65, 'name': 'dick'})
+
+	# Fields containing the separator are quoted
+	>>> sdb = SDB(data=[['tom', 18, 'Student, part-time']], cols=['name', 'age', 'occupation'], id='name')
+	>>> sdb.save('occup.dat')
+	>>> open('occup.dat').read()
+	'tom,18,"Student, part-time"\\n'
+	>>> SDB(path='occup.dat', cols=['name', 'age', 'occupation'], id='name', col_types=[str, int, str]).get('tom')
+	{'age': 18, 'name': 'tom', 'occupation': 'Student, part-time'}
+
+	# Quoted fields may contain newlines, in all modes
+	>>> sdb = SDB(path='occup.dat', cols=['name', 'age', 'occupation'], id='name', col_types=[str, int, str], journal=True)
+	>>> sdb.insert(['dick', 65, 'Retired\\nmostly'])
+	>>> sdb.save()
+	>>> SDB(path='occup.dat', cols=['name', 'age', 'occupation'], id='name', col_types=[str, int, str], journal=True).get('dick')
+	{'age': 65, 'name': 'dick', 'occupation': 'Retired\\nmostly'}
+	>>> sdb.save('occup.txt')
+	>>> [row['occupation'] for row in SDB(path='occup.txt', cols=['name', 'age', 'occupation'], id='name', col_types=[str, int, str], stream=True)]
+	['Student, part-time', 'Retired\\nmostly']
+
 	# Cleanup
+	>>> os.unlink('occup.txt')
 	>>> os.unlink('occup.dat')
+	>>> os.unlink('occup.dat.idx')
+	>>> os.unlink('occup.dat.journal')
 	"""
-	def __init__(self, path=None, data=None, sep=',', id=None, cols=[], col_types=None):
+	def __init__(self, path=None, data=None, sep=',', id=None, cols=[], col_types=None, indexes=None, columnar=False, stream=False, journal=False, journal_max=4194304, workers=None, views=False):
 		self.path = path
 		self.sep = sep
 		self.cols = cols
+		self._col_map = dict([(col, col_index) for col_index, col in enumerate(cols)])
 		self.id = id
 		self.col_types = col_types
+		self.columnar = columnar
+		self.stream = stream
+		self.offsets = None
+		self.journal = journal
+		self.journal_max = journal_max
+		self.workers = workers
+		self.views = views
+
+		self._journal_lines = []       # Unsaved journal records
+		self._journal_ok = False       # Journal on disk matches self.data
+		self._journal_lock = threading.Lock()
+		self._compactor = None
+
+		if columnar and not col_types:
+			raise SDBError("Columnar storage requires col_types")
+		if stream and (columnar or data or not path):
+			raise SDBError("Streaming mode requires a path and no data or columnar storage")
+		if journal and (stream or not path):
+			raise SDBError("Journal mode requires a path and can't be used with streaming")
 
 		self.data = []
 		self.id_key = None
 
-		# If user specified data as a parameter, set it. Otherwise, if the user
-		# specified a path to a file, read data from that file.
-		if data:
-			self.data = data
-		elif path:
-			self.load(path)
-		else:
-			self.data = []
-
 		# Resolve the id
 		if id:
 			try:
@@ -108,26 +798,218 @@ class SDB(object):
 			self.id = 0
 			self.id_index = 0
 
-	def load(self, path):
+		# The id column is always indexed. Other columns can be indexed by
+		# passing their names in `indexes` or through `add_index()`.
+		self.indexes = {}
+		if not stream:
+			self.indexes[self.id_index] = Index(self.id_index)
+		for col in indexes or []:
+			self.add_index(col)
+
+		# In streaming mode, rows are read from the file when needed.
+		# Otherwise, if user specified data as a parameter, set it. Otherwise,
+		# if the user specified a path to a file, read data from that file.
+		if stream:
+			self.data = FileRows(path, self._parse_line, sep if len(sep) == 1 else None)
+			self._load_offset_index()
+		elif data:
+			if columnar:
+				self.data = ColumnStore(col_types, data)
+			else:
+				self.data = data
+			self.reindex()
+		elif path:
+			self.load(path)
+		else:
+			self.data = self._new_storage()
+
+	def load(self, path, batch_size=10000):
 		"""
 		Load data from a file. Uses `self.sep` and `self.col_types`.
+
+		If `self.sep` is a single character, the file is read with the `csv`
+		module's reader, so fields may be quoted to contain the separator,
+		quotes or newlines. Rows are read and converted to `col_types` in
+		batches of `batch_size` rows, a column at a time. Apart from the
+		loaded data itself (see `columnar` storage for a compact form),
+		memory use is bounded by the batch size. Empty lines are skipped.
+
+		Sets `self.load_stats` to a dict with the number of 'rows', the
+		'seconds' it took and the 'rows_per_sec'.
 		"""
-		self.data = []
-		with open(path) as f:
+		start = time.time()
+		self.data = self._new_storage()
+		with open(path, 'rb') as f:
+			if len(self.sep) == 1:
+				reader = csv.reader(f, delimiter=self.sep)
+			else:
+				reader = (line.rstrip('\r\n').split(self.sep) for line in f)
+			while True:
+				batch = [row for row in islice(reader, batch_size) if row]
+				if not batch:
+					break
+				self._load_batch(batch)
+		if self.journal and path == self.path:
+			self._replay_journal()
+		self.reindex()
+
+		seconds = time.time() - start
+		self.load_stats = {
+			'rows': len(self.data),
+			'seconds': seconds,
+			'rows_per_sec': len(self.data) / seconds if seconds else None,
+		}
+
+	def _load_batch(self, batch):
+		"""
+		Convert a batch of rows of strings to `col_types` and add them to
+		`self.data`.
+		"""
+		if not self.col_types:
+			self.data.extend(batch)
+			return
+		nr_cols = len(self.col_types)
+		if set(map(len, batch)) != set([nr_cols]):
+			# Ragged rows; convert them one by one.
+			for row in batch:
+				self.data.append([f(x) for f, x in zip(self.col_types, row)])
+			return
+		columns = [map(f, column) for f, column in zip(self.col_types, zip(*batch))]
+		if self.columnar:
+			self.data.extend_columns(columns)
+		else:
+			self.data.extend(map(list, zip(*columns)))
+
+	def _replay_journal(self):
+		"""
+		Apply the records in the journal to `self.data`, if the journal belongs
+		to the current contents of the base file. A partially written last
+		record is ignored. If a compaction was interrupted after it replaced
+		the base file, its new journal is used instead.
+
+		A journal that belongs to other contents (e.g. because the base file
+		was rewritten by a full `save()` without journal mode) is moved aside
+		to `path` + '.journal.N' with a warning, and a new one is started.
+		"""
+		self._journal_ok = False
+		self._journal_lines = []
+		journal_path = self.path + '.journal'
+		header = '#sdb-journal %s\n' % (_file_digest(self.path))
+		headers = (header, '#sdb-journal %s\n' % (_file_id(self.path)))
+		try:
+			with open(journal_path + '.tmp') as f:
+				tmp_header = f.readline()
+			if tmp_header in headers:
+				# A compaction was interrupted after replacing the base
+				# file. Finish it.
+				os.rename(journal_path + '.tmp', journal_path)
+		except IOError:
+			pass
+		try:
+			f = open(journal_path)
+		except IOError:
+			f = None
+		if f is None or f.readline() not in headers:
+			if f is not None:
+				has_records = f.read(1) != ''
+				f.close()
+				if has_records:
+					new_path = _move_aside(journal_path)
+					warnings.warn("Journal %s doesn't match %s; moved it to %s" % (journal_path, self.path, new_path))
+			with open(journal_path, 'w') as f:
+				f.write(header)
+			self._journal_ok = True
+			return
+		with f:
+			quoted = len(self.sep) == 1
+			lines = _records(f, self.sep) if quoted else f
+			for line in lines:
+				if not line.endswith('\n') or \
+				   (quoted and '"' in line and _in_quotes(line, self.sep)):
+					break
+				op, rest = line.split(self.sep, 1)
+				if op == 'I':
+					self.data.append(self._parse_line(rest))
+				elif op == 'U':
+					pos, rest = rest.split(self.sep, 1)
+					self.data[int(pos)] = self._parse_line(rest)
+				elif op == 'D':
+					self.data.pop(int(rest))
+		self._journal_ok = True
+
+	def build_offset_index(self):
+		"""
+		Streaming mode only. Scan the file once and write a sidecar file
+		(`path` + '.idx') mapping each id to the byte offset of its row, so
+		that `get()` can seek straight to the row. The sidecar is loaded
+		automatically when the file is opened in streaming mode, unless the
+		file has been modified since the sidecar was written.
+		"""
+		self._check_stream()
+		self.offsets = {}
+		with open(self.path + '.idx', 'w') as f:
+			for offset, row in self.data.offsets():
+				id = row[self.id_index]
+				if id not in self.offsets:
+					self.offsets[id] = offset
+					f.write('%s%s%s\n' % (offset, self.sep, id))
+
+	def _load_offset_index(self):
+		idx_path = self.path + '.idx'
+		try:
+			if os.path.getmtime(idx_path) < os.path.getmtime(self.path):
+				return # Stale
+		except OSError:
+			return # No index
+		id_type = str
+		if self.col_types:
+			id_type = self.col_types[self.id_index]
+		self.offsets = {}
+		with open(idx_path) as f:
 			for line in f:
-				cols = line.rstrip().split(self.sep)
-				if self.col_types:
-					self.data.append([f(x) for f, x in zip(self.col_types, cols)])
-				else:
-					self.data.append(cols)
+				offset, id = line.rstrip('\r\n').split(self.sep, 1)
+				self.offsets[id_type(id)] = int(offset)
+
+	def _format_row(self, row):
+		"""
+		Turn a row into a line for a file. If `self.sep` is a single
+		character, fields containing it, quotes or newlines are quoted the way
+		the `csv` module does.
+		"""
+		cols = [str(col) for col in row]
+		if len(self.sep) == 1:
+			for i, col in enumerate(cols):
+				if self.sep in col or '"' in col or '\n' in col or '\r' in col:
+					cols[i] = '"%s"' % (col.replace('"', '""'))
+		return(self.sep.join(cols) + '\n')
+
+	def _parse_line(self, line):
+		"""
+		Turn a line from a file into a row. Uses `self.sep` and
+		`self.col_types`. Quoted fields may contain newlines, so the "line"
+		can span several lines of the file (see `_records()`).
+		"""
+		if '"' in line and len(self.sep) == 1:
+			cols = csv.reader([line], delimiter=self.sep).next()
+		else:
+			cols = line.rstrip('\r\n').split(self.sep)
+		if self.col_types:
+			return([f(x) for f, x in zip(self.col_types, cols)])
+		return(cols)
 
 	def save(self, path=None):
 		"""
 		Save data to a file. Uses `self.sep` and `self.col_types`.
 		"""
+		if self.stream and (not path or path == self.path):
+			raise SDBError("Can't save a streaming SDB to the file it reads from")
+		if self.journal and (not path or path == self.path):
+			self._save_journal()
+			return
+
 		if not path:
 			path = self.path
-		else:
+		elif not self.stream and not self.journal:
 			self.path = path
 
 		if not path:
@@ -135,72 +1017,708 @@ class SDB(object):
 
 		with file(path, 'w') as f:
 			for row in self.data:
-				f.write(self.sep.join([str(col) for col in row]) + '\n')
+				f.write(self._format_row(row))
+
+	def compact(self, wait=True):
+		"""
+		Journal mode only. Rewrite the base file with the current data and
+		start a new, empty journal. This happens automatically in a background
+		thread when `save()` finds that the journal has grown beyond
+		`journal_max` bytes. If `wait` is False, compact in the background.
+		"""
+		if not self.journal:
+			raise SDBError("Only supported in journal mode")
+		self.save()
+		while True:
+			# A running compactor needs the lock to finish, so wait for it
+			# without holding the lock.
+			if self._compactor is not None:
+				self._compactor.join()
+			with self._journal_lock:
+				if self._compactor is not None and self._compactor.is_alive():
+					continue
+				rows = [list(row) for row in self.data]
+				offset = os.path.getsize(self.path + '.journal')
+				self._compactor = threading.Thread(target=self._compact, args=(rows, offset))
+				self._compactor.start()
+				break
+		if wait:
+			self._compactor.join()
+
+	def _save_journal(self):
+		"""
+		Append the unsaved journal records to the journal. If there is no
+		valid journal yet, write the base file and start a new journal
+		instead. Starts a background compaction if the journal has grown too
+		large.
+		"""
+		with self._journal_lock:
+			if not self._journal_ok:
+				self._compact([list(row) for row in self.data], None, locked=True)
+				return
+			with open(self.path + '.journal', 'a') as f:
+				f.write(''.join(self._journal_lines))
+				f.flush()
+				os.fsync(f.fileno())
+				offset = f.tell()
+			self._journal_lines = []
+
+			if offset > self.journal_max and \
+			   (self._compactor is None or not self._compactor.is_alive()):
+				rows = [list(row) for row in self.data]
+				self._compactor = threading.Thread(target=self._compact, args=(rows, offset))
+				self._compactor.start()
+
+	def _compact(self, rows, offset, locked=False):
+		"""
+		Write `rows` to the base file and start a new journal. `offset` is the
+		size the journal had when `rows` was taken from `self.data`; records
+		that were appended after it are carried over to the new journal.
+		"""
+		base_tmp = self.path + '.tmp'
+		journal_tmp = self.path + '.journal.tmp'
+		with open(base_tmp, 'w') as f:
+			for row in rows:
+				f.write(self._format_row(row))
+			f.flush()
+			os.fsync(f.fileno())
+		header = '#sdb-journal %s\n' % (_file_digest(base_tmp))
+
+		if not locked:
+			self._journal_lock.acquire()
+		try:
+			tail = ''
+			if offset is not None:
+				with open(self.path + '.journal') as f:
+					f.seek(offset)
+					tail = f.read()
+			with open(journal_tmp, 'w') as f:
+				f.write(header + tail)
+				f.flush()
+				os.fsync(f.fileno())
+			# If we crash between these renames, the old journal no longer
+			# matches the new base file and the new one is picked up from
+			# `journal_tmp` on load.
+			os.rename(base_tmp, self.path)
+			os.rename(journal_tmp, self.path + '.journal')
+			if offset is None:
+				self._journal_lines = []
+			self._journal_ok = True
+		finally:
+			if not locked:
+				self._journal_lock.release()
+
+	def add_index(self, col, sorted=False):
+		"""
+		Add a hash index on column `col` (a column name, or a position if there
+		are no column names). Indexes make `get()` and `getx()` on that column
+		O(1). They are kept up to date by `insert()`, `update()` and
+		`delete()`. If you modify `self.data` directly, call `reindex()`.
+
+		If `sorted` is True, add a `SortedIndex` instead. Lookups cost
+		O(log n), but it also answers range conditions in declarative
+		predicates and lets `select()` return rows ordered by the column
+		without sorting them. It replaces any existing index on the column.
+		"""
+		self._check_writable()
+		col_index = self._col_index(col)
+		if sorted:
+			index = SortedIndex(col_index)
+		else:
+			index = Index(col_index)
+		index.build(self.data)
+		self.indexes[col_index] = index
+
+	def column(self, col):
+		"""
+		Return all values of column `col`. With columnar storage, this is the
+		underlying `array.array` (or list), which must not be modified. It can
+		be handed to NumPy with `numpy.frombuffer()` without copying.
+		"""
+		col_index = self._col_index(col)
+		if self.columnar:
+			return(self.data.columns[col_index])
+		return([row[col_index] for row in self.data])
+
+	def reindex(self):
+		"""
+		Rebuild all indexes from `self.data`.
+		"""
+		for index in self.indexes.values():
+			index.build(self.data)
 
 	def get(self, id):
 		"""
 		Get a row by its id (`self.id`)
 		"""
-		for row in self.data:
-			if row[self.id_index] == id:
-				return(self._make_drow(row))
+		if self.stream:
+			if self.offsets is not None:
+				if id in self.offsets:
+					return(self._make_drow(self.data.read_at(self.offsets[id])))
+				return(None)
+			for row in self.data:
+				if row[self.id_index] == id:
+					return(self._make_drow(row))
+			return(None)
+		for pos in self.indexes[self.id_index].lookup(id):
+			return(self._make_drow(self.data[pos]))
 
 	def getx(self, **kwargs):
 		"""
 		Get a row by multiple columns
 		"""
-		for row in self.data:
-			match = True
-			for colname, value in kwargs.items():
-				if row[self.cols.index(colname)] != value:
-					match = False
-			if match:
+		conds = [(self._col_index(colname), value) for colname, value in kwargs.items()]
+
+		# Use an index to narrow down the candidate rows, if there is one.
+		candidates = None
+		for col_index, value in conds:
+			if col_index in self.indexes:
+				candidates = [self.data[pos] for pos in self.indexes[col_index].lookup(value)]
+				break
+		if candidates is None:
+			candidates = self.data
+
+		for row in candidates:
+			for col_index, value in conds:
+				if row[col_index] != value:
+					break
+			else:
 				return(self._make_drow(row))
 
-	def select(self, select_cb=None, sort_cb=None):
+	def select(self, select_cb=None, sort_cb=None, workers=None, order_by=None, limit=None, offset=0):
 		"""
 		Select data using a callback function `select_cb` which should return
 		True or False if the row should be included in the results. `sort_cb`
 		can be used as a sorting callback. See help documentation for the SDB
 		class for examples.
+
+		The callback is passed a read-only `RowView` on each row, which is
+		cheaper to build than a dict. The results are dicts, or views if
+		`views` was set on the SDB.
+
+		Instead of a callback, `select_cb` can be a declarative predicate:
+
+		  {col: value, ...}            All columns equal the values.
+		  {col: (op, arg), ...}        All conditions are true. `op` is one of
+		                               ==, !=, <, <=, >, >=, in, prefix or
+		                               between (`arg` is a (low, high) tuple).
+		  ('and', pred, pred, ...)     All predicates match.
+		  ('or', pred, pred, ...)      Any predicate matches.
+		  ('not', pred)                The predicate doesn't match.
+
+		Declarative predicates are evaluated directly on the rows, so no
+		dicts are built for rows that don't match, and equality and `in`
+		conditions on indexed columns are answered from the index. `update()`
+		and `delete()` accept them as well.
+
+		If `workers` (or `self.workers`) is more than 1, the rows are split
+		into chunks that are filtered in parallel by that many worker
+		processes. In streaming mode, the file is split by byte ranges. The
+		workers are forked (POSIX only), so callbacks don't need to be
+		picklable, but the callback only sees the data as it was when the
+		query started and can't have side effects in this process. Predicates
+		that can be answered from an index are never run in parallel.
+		`update()`, `delete()` and `aggregate()` take `workers` too.
+
+		`order_by` sorts the results by a column name, or a list of them for
+		multi-column ordering. Prefix a name with '-' to sort descending. The
+		rows are sorted on their raw values, which is much faster than a
+		`sort_cb`. If the ordering is on a single column with a sorted index
+		(see `add_index()`), the rows are read from the index in order
+		instead. `offset` skips results and `limit` limits their number; with
+		`order_by`, only the top `offset + limit` rows are selected (with a
+		heap, or by stopping early on a sorted index) instead of sorting them
+		all.
 		"""
-		results = []
-		for row in self.data:
-			drow = self._make_drow(row)
-			if not select_cb or select_cb(drow):
-				results.append(drow)
 		if sort_cb:
+			results = list(self.iselect(select_cb, workers))
 			results.sort(sort_cb)
+			if limit is None:
+				return(results[offset:])
+			return(results[offset:offset + limit])
+
+		end = None
+		if limit is not None:
+			end = offset + limit
+
+		if not order_by:
+			rows = islice(self._matches(select_cb, workers), offset, end)
+			return([self._make_drow(row) for pos, row in rows])
+
+		if isinstance(order_by, basestring):
+			order_by = [order_by]
+		sort_cols = []
+		for col in order_by:
+			if col.startswith('-'):
+				sort_cols.append((self._col_index(col[1:]), True))
+			else:
+				sort_cols.append((self._col_index(col), False))
+
+		index = None
+		if len(sort_cols) == 1:
+			index = self.indexes.get(sort_cols[0][0])
+		if isinstance(index, SortedIndex):
+			test = self._test(select_cb)
+			rows = (self.data[pos] for pos in index.ordered(reverse=sort_cols[0][1]))
+			rows = islice((row for row in rows if test(row)), offset, end)
+			return([self._make_drow(row) for row in rows])
+
+		rows = [row for pos, row in self._matches(select_cb, workers)]
+		if len(set([desc for col_index, desc in sort_cols])) == 1:
+			key = operator.itemgetter(*[col_index for col_index, desc in sort_cols])
+			reverse = sort_cols[0][1]
+			if end is None:
+				rows.sort(key=key, reverse=reverse)
+			elif reverse:
+				rows = heapq.nlargest(end, rows, key=key)
+			else:
+				rows = heapq.nsmallest(end, rows, key=key)
+		elif end is None:
+			# Mixed directions: sort stably on each column, least significant
+			# first.
+			for col_index, desc in reversed(sort_cols):
+				rows.sort(key=operator.itemgetter(col_index), reverse=desc)
+		else:
+			key = lambda row: tuple([_Desc(row[col_index]) if desc else row[col_index] for col_index, desc in sort_cols])
+			rows = heapq.nsmallest(end, rows, key=key)
+		return([self._make_drow(row) for row in rows[offset:end]])
+
+	def iselect(self, select_cb=None, workers=None):
+		"""
+		Like `select()`, but return a generator that yields the matching rows
+		one by one. In streaming mode, this reads the file lazily.
+		"""
+		for pos, row in self._matches(select_cb, workers):
+			yield self._make_drow(row)
+
+	def aggregate(self, aggs, select_cb=None, group_by=None, workers=None):
+		"""
+		Compute aggregates over the rows that match `select_cb` (see
+		`select()`) in a single pass, without building dicts for the rows.
+		`aggs` maps result names to `(function, column)` tuples, where function
+		is one of 'count', 'sum', 'min', 'max' or 'avg' (column is ignored for
+		'count'). Returns a dict with the results.
+
+		If `group_by` is a column name (or a list of column names), returns a
+		dict mapping each distinct value (or tuple of values) of those columns
+		to a dict with the results for that group.
+		"""
+		names = aggs.keys()
+		funcs = [aggs[name][0] for name in names]
+		for func in funcs:
+			if func not in AGGREGATES:
+				raise SDBError("Unknown aggregate function '%s'" % (func))
+		col_indexes = [self._col_index(aggs[name][1]) if aggs[name][0] != 'count' else None for name in names]
+
+		if self.columnar and not select_cb and not group_by and len(self.data):
+			# Let the builtins run over the column arrays directly.
+			result = {}
+			for name, func, col_index in zip(names, funcs, col_indexes):
+				if func == 'count':
+					result[name] = len(self.data)
+				elif func == 'avg':
+					result[name] = sum(self.data.columns[col_index]) / float(len(self.data))
+				else:
+					result[name] = {'sum': sum, 'min': min, 'max': max}[func](self.data.columns[col_index])
+			return(result)
+
+		if group_by is None:
+			group_key = lambda row: None
+		elif isinstance(group_by, (list, tuple)):
+			group_indexes = [self._col_index(col) for col in group_by]
+			group_key = lambda row: tuple([row[i] for i in group_indexes])
+		else:
+			group_index = self._col_index(group_by)
+			group_key = lambda row: row[group_index]
+
+		inits = [AGGREGATES[func][0] for func in funcs]
+		updates = zip(range(len(funcs)), [AGGREGATES[func][1] for func in funcs], col_indexes)
+		def aggregate_rows(matches):
+			groups = {}
+			for pos, row in matches:
+				key = group_key(row)
+				state = groups.get(key)
+				if state is None:
+					state = groups[key] = [init() for init in inits]
+				for i, update, col_index in updates:
+					state[i] = update(state[i], None if col_index is None else row[col_index])
+			return(groups)
+
+		workers = workers or self.workers
+		if workers > 1 and self._parallel_ok(select_cb):
+			test = self._test(select_cb)
+			def job(chunk):
+				return(aggregate_rows((pos, row) for pos, row in self._iter_range(*chunk) if test(row)))
+			merges = [AGGREGATES[func][3] for func in funcs]
+			groups = {}
+			for chunk_groups in _parallel_map(job, self._chunks(workers), workers):
+				for key, state in chunk_groups.items():
+					if key in groups:
+						groups[key] = [merge(a, b) for merge, a, b in zip(merges, groups[key], state)]
+					else:
+						groups[key] = state
+		else:
+			groups = aggregate_rows(self._matches(select_cb))
+
+		if group_by is None and not groups:
+			groups[None] = [init() for init in inits]
+		finals = [AGGREGATES[func][2] for func in funcs]
+		results = {}
+		for key, state in groups.items():
+			results[key] = dict(zip(names, [final(acc) for final, acc in zip(finals, state)]))
+		if group_by is None:
+			return(results[None])
 		return(results)
 
 	def insert(self, values):
+		self._check_writable()
 		self.data.append(values)
+		pos = len(self.data) - 1
+		for col_index, index in self.indexes.items():
+			index.add(values[col_index], pos)
+		if self.journal:
+			self._journal_lines.append('I' + self.sep + self._format_row(values))
 
-	def update(self, values, select_cb):
-		for i in range(0, len(self.data)):
-			row = self.data[i]
-			drow = self._make_drow(row)
-			if select_cb(drow):
-				for key, value in values.items():
-					if self.cols:
-						row[self.cols.index(key)] = value
-					else:
-						row[key] = value
+	def insert_many(self, rows):
+		"""
+		Insert a sequence of rows in one go. Much faster than calling
+		`insert()` for each row.
+		"""
+		self._check_writable()
+		rows = list(rows)
+		start = len(self.data)
+		self.data.extend(rows)
+		for col_index, index in self.indexes.items():
+			if isinstance(index, SortedIndex):
+				if len(rows) * 16 > start:
+					# Cheaper to sort everything again than to insort each row
+					index.build(self.data)
+				else:
+					for pos, row in enumerate(rows, start):
+						index.add(row[col_index], pos)
+			else:
+				index.extend([row[col_index] for row in rows], start)
+		if self.journal:
+			self._journal_lines.extend(['I' + self.sep + self._format_row(row) for row in rows])
+
+	def update(self, values, select_cb, workers=None):
+		"""
+		Set the columns in dict `values` for all rows matching `select_cb` (a
+		callback or a declarative predicate). Matching rows are found first,
+		then each column is updated for all of them at once. Indexes on the
+		updated columns are rebuilt if a large part of the rows changed.
+		"""
+		self._check_writable()
+		self._check_predicate(select_cb)
+		values = [(self._col_index(key), value) for key, value in values.items()]
+		positions = [pos for pos, row in self._matches(select_cb, workers)]
+		rebuild = len(positions) * 16 > len(self.data)
+		for col_index, value in values:
+			index = self.indexes.get(col_index)
+			if index is not None and not rebuild:
+				for pos in positions:
+					old_value = self.data[pos][col_index]
+					if old_value != value:
+						index.remove(old_value, pos)
+						index.add(value, pos)
+			if self.columnar:
+				self.data.set_values(col_index, positions, value)
+			else:
+				data = self.data
+				for pos in positions:
+					data[pos][col_index] = value
+			if index is not None and rebuild:
+				index.build(self.data)
+		if self.journal:
+			self._journal_lines.extend([
+				'U%s%d%s%s' % (self.sep, pos, self.sep, self._format_row(self.data[pos]))
+				for pos in positions
+			])
+
+	def delete(self, select_cb, workers=None):
+		"""
+		Delete all rows matching `select_cb` (a callback or a declarative
+		predicate). The remaining rows are copied into new storage in a single
+		pass, rather than removing the rows one by one.
+		"""
+		self._check_writable()
+		self._check_predicate(select_cb)
+		deleted = [pos for pos, row in self._matches(select_cb, workers)]
+		if not deleted:
+			return
+		dead = set(deleted)
+		keep = [pos for pos in xrange(len(self.data)) if pos not in dead]
+		if self.columnar:
+			self.data.keep(keep)
+		else:
+			data = self.data
+			data[:] = [data[pos] for pos in keep]
+		if self.journal:
+			# Positions as they are when the records are replayed in order
+			self._journal_lines.extend(['D%s%d\n' % (self.sep, pos) for pos in reversed(deleted)])
+		# Row positions have shifted
+		self.reindex()
+
+	def _matches(self, select_cb, workers=None):
+		"""
+		Yield `(position, row)` for all rows that match `select_cb`, which can
+		be None (all rows), a callback or a declarative predicate. Filters in
+		`workers` processes if it (or `self.workers`) is more than 1; in
+		streaming mode, the position is then None.
+		"""
+		workers = workers or self.workers
+		# Without a predicate there's nothing to filter, so nothing to gain.
+		if workers > 1 and select_cb and self._parallel_ok(select_cb):
+			test = self._test(select_cb)
+			if self.stream:
+				job = lambda chunk: [row for pos, row in self._iter_range(*chunk) if test(row)]
+				for rows in _parallel_map(job, self._chunks(workers), workers):
+					for row in rows:
+						yield None, row
+			else:
+				job = lambda chunk: [pos for pos, row in self._iter_range(*chunk) if test(row)]
+				for positions in _parallel_map(job, self._chunks(workers), workers):
+					for pos in positions:
+						yield pos, self.data[pos]
+		elif not select_cb:
+			for pos, row in enumerate(self.data):
+				yield pos, row
+		elif callable(select_cb):
+			make_view = self._make_view
+			for pos, row in enumerate(self.data):
+				if select_cb(make_view(row)):
+					yield pos, row
+		else:
+			test = self._compile(select_cb)
+			candidates = self._plan(select_cb)
+			if candidates is None:
+				for pos, row in enumerate(self.data):
+					if test(row):
+						yield pos, row
+			else:
+				for pos in candidates:
+					row = self.data[pos]
+					if test(row):
+						yield pos, row
+
+	def _test(self, select_cb):
+		"""
+		Return a function that takes a raw row and returns True if it matches
+		`select_cb` (None, a callback or a declarative predicate).
+		"""
+		if not select_cb:
+			return(lambda row: True)
+		if callable(select_cb):
+			return(lambda row: select_cb(self._make_view(row)))
+		return(self._compile(select_cb))
+
+	def _parallel_ok(self, select_cb):
+		"""
+		Return True if it's worth going through the rows matching `select_cb`
+		in parallel, rather than finding them with an index.
+		"""
+		if not select_cb or callable(select_cb) or self.stream:
+			return(True)
+		return(self._plan(select_cb) is None)
+
+	def _chunks(self, workers):
+		"""
+		Split the data into ranges for `workers` worker processes: row
+		positions, or byte offsets in streaming mode. Makes a few chunks per
+		worker, so that a slow chunk doesn't hold up the others.
+		"""
+		if self.stream:
+			size = os.path.getsize(self.path)
+		else:
+			size = len(self.data)
+		step = max(1, -(-size // (workers * 4)))
+		starts = range(0, size, step)
+		if self.stream and len(self.sep) == 1:
+			# A line may continue a quoted field of the row before it, so
+			# chunks have to start at known row offsets.
+			if self.offsets:
+				offsets = sorted(self.offsets.itervalues())
+				starts = [offsets[bisect.bisect_left(offsets, start)] if start <= offsets[-1] else size for start in starts]
+			else:
+				starts = self.data.align(starts)
+		ends = starts[1:] + [size]
+		return([(start, end) for start, end in zip(starts, ends) if start < end])
+
+	def _iter_range(self, start, end):
+		"""
+		Yield `(position, row)` for the rows in chunk [start, end) (see
+		`_chunks()`). In streaming mode, the position is None.
+		"""
+		if self.stream:
+			for row in self.data.rows_between(start, end):
+				yield None, row
+		else:
+			data = self.data
+			for pos in xrange(start, end):
+				yield pos, data[pos]
+
+	def _compile(self, pred):
+		"""
+		Turn a declarative predicate into a function that takes a raw row and
+		returns True if it matches.
+		"""
+		if isinstance(pred, dict):
+			tests = []
+			for col, cond in pred.items():
+				col_index = self._col_index(col)
+				if isinstance(cond, tuple):
+					op, arg = cond
+				else:
+					op, arg = '==', cond
+				if op not in OPS:
+					raise SDBError("Unknown operator '%s'" % (op))
+				if op == 'in':
+					try:
+						arg = frozenset(arg)
+					except TypeError:
+						pass
+				tests.append(_leaf_test(col_index, OPS[op], arg))
+			return(reduce(_and_test, tests))
+		if isinstance(pred, (tuple, list)) and len(pred) > 1:
+			tests = [self._compile(sub_pred) for sub_pred in pred[1:]]
+			if pred[0] == 'and':
+				return(reduce(_and_test, tests))
+			if pred[0] == 'or':
+				return(reduce(_or_test, tests))
+			if pred[0] == 'not' and len(tests) == 1:
+				return(_not_test(tests[0]))
+		raise SDBError("Invalid predicate %r" % (pred, ))
+
+	def _plan(self, pred):
+		"""
+		Return a sorted list of positions of the rows that may match the
+		declarative predicate `pred`, using the available indexes. Returns None
+		if the predicate can't be answered from the indexes, in which case all
+		rows must be scanned. The predicate still has to be tested against the
+		returned rows.
+		"""
+		if isinstance(pred, dict):
+			best = None
+			for col, cond in pred.items():
+				index = self.indexes.get(self._col_index(col))
+				if index is None:
+					continue
+				if not isinstance(cond, tuple):
+					candidates = index.lookup(cond)
+				elif cond[0] == '==':
+					candidates = index.lookup(cond[1])
+				elif cond[0] == 'in':
+					candidates = set()
+					for value in cond[1]:
+						candidates.update(index.lookup(value))
+				elif isinstance(index, SortedIndex) and cond[0] in SortedIndex.RANGE_OPS:
+					candidates = index.range(*cond)
+				else:
+					continue
+				if best is None or len(candidates) < len(best):
+					best = candidates
+			if best is None and self.columnar:
+				return(self._plan_columns(pred))
+			if best is None:
+				return(None)
+			return(sorted(best))
+		if pred[0] == 'and':
+			best = None
+			for candidates in [self._plan(sub_pred) for sub_pred in pred[1:]]:
+				if candidates is not None and (best is None or len(candidates) < len(best)):
+					best = candidates
+			return(best)
+		if pred[0] == 'or':
+			union = set()
+			for sub_pred in pred[1:]:
+				candidates = self._plan(sub_pred)
+				if candidates is None:
+					return(None)
+				union.update(candidates)
+			return(sorted(union))
+		return(None)
+
+	def _check_writable(self):
+		if self.stream:
+			raise SDBError("Not supported in streaming mode")
+
+	def _check_predicate(self, select_cb):
+		# An empty predicate would match, and change, all rows.
+		if not callable(select_cb) and not select_cb:
+			raise SDBError("A predicate is required, got %r" % (select_cb, ))
+
+	def _check_stream(self):
+		if not self.stream:
+			raise SDBError("Only supported in streaming mode")
+
+	def _new_storage(self):
+		if self.columnar:
+			return(ColumnStore(self.col_types))
+		return([])
 
-	def delete(self, select_cb):
-		for i in range(len(self.data), 0, -1):
-			if select_cb(self._make_drow(self.data[i-1])):
-				self.data.pop(i-1)
+	def _col_index(self, col):
+		"""
+		Return the position of column `col` in a row. `col` can be a column
+		name, or a position if there are no column names.
+		"""
+		if self.cols:
+			try:
+				return(self.cols.index(col))
+			except ValueError:
+				raise SDBError("Unknown column '%s'" % (col))
+		return(col)
+
+	def _plan_columns(self, pred):
+		"""
+		Answer the comparisons in the dict predicate `pred` by scanning the
+		numeric columns of a `ColumnStore` directly. Returns the sorted
+		positions that match all of them, or None if there are none to scan.
+		"""
+		result = None
+		for col, cond in pred.items():
+			col_index = self._col_index(col)
+			if not isinstance(self.data.columns[col_index], array.array):
+				continue
+			if not isinstance(cond, tuple):
+				cond = ('==', cond)
+			if cond[0] == 'between':
+				low, high = cond[1]
+				positions = set(self.data.scan(col_index, operator.ge, low))
+				positions.intersection_update(self.data.scan(col_index, operator.le, high))
+			elif cond[0] in ('==', '!=', '<', '<=', '>', '>='):
+				positions = set(self.data.scan(col_index, OPS[cond[0]], cond[1]))
+			else:
+				continue
+			if result is None:
+				result = positions
+			else:
+				result.intersection_update(positions)
+		if result is None:
+			return(None)
+		return(sorted(result))
 
 	def _make_drow(self, row):
 		"""
-		Turn a row into a dictionary mapping if column names are available.
+		Turn a row into a dictionary mapping if column names are available,
+		or a `RowView` on it if `self.views` is set.
 		"""
+		if self.views:
+			return(self._make_view(row))
 		if self.cols:
 			return(dict(zip(self.cols, row)))
 		else:
 			return(row)
 
+	def _make_view(self, row):
+		"""
+		Turn a row into a `RowView` if column names are available. Callbacks
+		are always passed views, since they rarely need a copy of the row.
+		"""
+		if self.cols:
+			return(RowView(self._col_map, row))
+		else:
+			return(row)
+
 	def __iter__(self):
 		for row in self.data:
 			yield self._make_drow(row)